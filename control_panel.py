@@ -166,7 +166,7 @@ class ControlPanel:
         labels = [
             ('Dimensions', ': ', self._validate_int, (1, 30)),
             ('Node size', ' (in bytes): ', self._validate_int, (128, 8192)),
-            ('Split type', ' (\'bruteforce\', \'quadratic\', \'linear\'): ', self._validate_choice, ['bruteforce', 'quadratic', 'linear'])
+            ('Split type', ' (\'bruteforce\', \'quadratic\', \'linear\', \'rstar\', \'hilbert\'): ', self._validate_choice, ['bruteforce', 'quadratic', 'linear', 'rstar', 'hilbert'])
         ]
         labels_w = max(len(l) + len(h) for l, h, _, _ in labels)
 
@@ -329,7 +329,7 @@ class ControlPanel:
 
         try:
             old_name, tree = self._trees.pop(i)
-            del tree._storage
+            tree.close()
 
             old_path = os.path.join(self._dir, old_name + '.rtree')
             new_path = os.path.join(self._dir, args[1] + '.rtree')
@@ -348,7 +348,7 @@ class ControlPanel:
 
         try:
             name, tree = self._trees.pop(i)
-            del tree._storage
+            tree.close()
 
             os.remove(os.path.join(self._dir, name + '.rtree'))
             return 'R-tree deleted'
@@ -1 +1,3 @@
-from .rtree import RTree, RTreeSplitType
+from .rtree import RTree, RTreeSplitType, CoordType
+from .sync_policy import SyncPolicy, SyncMode
+from .executor import QueryExecutor
@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict, List
+
+
+class _Stripe:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # index -> (changed, is_leaf, entries), least recently used first
+        self.pages = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class BufferPool:
+    # pages are split by index into stripes with their own LRU and lock, so concurrent
+    # readers rarely wait for each other; a stripe is never smaller than _MIN_STRIPE_PAGES
+    STRIPES = 16
+    _MIN_STRIPE_PAGES = 64
+
+    def __init__(self, capacity: int, stripes: int = STRIPES):
+        if capacity < 1:
+            raise ValueError
+
+        self._capacity = capacity
+        stripes = max(1, min(stripes, capacity // self._MIN_STRIPE_PAGES))
+        self._stripes = [_Stripe(capacity // stripes + (1 if i < capacity % stripes else 0)) for i in range(stripes)]
+
+    def get_capacity(self) -> int:
+        return self._capacity
+
+    def get(self, index: int) -> Optional[Tuple[bool, tuple]]:
+        stripe = self._stripe(index)
+        with stripe.lock:
+            page = stripe.pages.get(index)
+            if page is None:
+                stripe.misses += 1
+                return None
+
+            stripe.hits += 1
+            stripe.pages.move_to_end(index)
+            return page[1], page[2]
+
+    # Returns the evicted pages that have to be written back
+    def put(self, index: int, is_leaf: bool, entries: tuple, changed: bool) -> List[Tuple[int, bool, tuple]]:
+        stripe = self._stripe(index)
+        evicted = list()
+        with stripe.lock:
+            if index in stripe.pages:
+                changed = changed or stripe.pages[index][0]
+                stripe.pages.move_to_end(index)
+            stripe.pages[index] = (changed, is_leaf, entries)
+
+            while len(stripe.pages) > stripe.capacity:
+                old_index, (old_changed, old_is_leaf, old_entries) = stripe.pages.popitem(last=False)
+                stripe.evictions += 1
+                if old_changed:
+                    evicted.append((old_index, old_is_leaf, old_entries))
+        return evicted
+
+    # Drops the page without writing it back
+    def discard(self, index: int):
+        stripe = self._stripe(index)
+        with stripe.lock:
+            stripe.pages.pop(index, None)
+
+    # Removes the page and returns it with its changed flag, so it can be kept elsewhere
+    def take(self, index: int) -> Optional[Tuple[bool, bool, tuple]]:
+        stripe = self._stripe(index)
+        with stripe.lock:
+            return stripe.pages.pop(index, None)
+
+    # Returns all changed pages ordered by index and marks them as written back
+    def flush(self) -> List[Tuple[int, bool, tuple]]:
+        dirty = list()
+        for stripe in self._stripes:
+            with stripe.lock:
+                for index, (changed, is_leaf, entries) in list(stripe.pages.items()):
+                    if changed:
+                        dirty.append((index, is_leaf, entries))
+                        stripe.pages[index] = (False, is_leaf, entries)
+        dirty.sort(key=lambda page: page[0])
+        return dirty
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'pages': 0, 'dirty': 0}
+        for stripe in self._stripes:
+            with stripe.lock:
+                stats['hits'] += stripe.hits
+                stats['misses'] += stripe.misses
+                stats['evictions'] += stripe.evictions
+                stats['pages'] += len(stripe.pages)
+                stats['dirty'] += sum(1 for changed, _, _ in stripe.pages.values() if changed)
+        return stats
+
+    def _stripe(self, index: int) -> _Stripe:
+        return self._stripes[index % len(self._stripes)]
@@ -0,0 +1,202 @@
+import struct
+import zlib
+from typing import Tuple, Optional
+from .node import NonLeafEntry, LeafEntry
+from .coord_type import CoordType
+
+
+class NodeCodec:
+    # node type(1B), number of entries(8B)
+    _HEADER = struct.Struct('<BQ')
+    _NON_LEAF = 0
+    _LEAF = 1
+    # slot of a deleted node, waiting to be reused
+    _FREE = 2
+    # crc32 of the rest of the page, stored in its last bytes
+    _CRC = struct.Struct('<I')
+
+    # grid cells per dimension of a compact non leaf node
+    _CELLS = 2 ** 16 - 1
+
+    def __init__(self, dim: int, node_size: int, checksum: bool = False, compact: bool = False,
+                 coord_type: CoordType = CoordType.INT64, key_size: int = 0, aggregate: bool = False):
+        self._dim = dim
+        self._node_size = node_size
+        self._checksum = checksum
+        self._compact = compact
+        self._coord_type = coord_type
+        self._key_size = key_size
+        self._aggregate = aggregate
+        self._integral = coord_type.is_integral()
+        # coords(of the coordinate type), data point or child index(8B),
+        # non leaf entries of aggregate trees then hold the number of data points in the subtree(8B),
+        # non leaf entries of Hilbert trees end with the largest Hilbert key of the subtree(key_size B)
+        coord = coord_type.get_format()
+        key = ('Q' if aggregate else '') + ('{}s'.format(key_size) if key_size else '')
+        self._leaf = struct.Struct('<{}{}Q'.format(dim, coord))
+        if compact:
+            # exact box of the node(8B per coord), then entry boxes on a grid over it(2B per coord),
+            # child index(4B)
+            self._box = struct.Struct('<{}{}'.format(2 * dim, coord_type.get_wide_format()))
+            self._non_leaf = struct.Struct('<{}HI{}'.format(2 * dim, key))
+            self._child = struct.Struct('<I')
+            self._child_offset = struct.calcsize('<{}H'.format(2 * dim))
+        else:
+            self._box = struct.Struct('')
+            self._non_leaf = struct.Struct('<{}{}Q{}'.format(2 * dim, coord, key))
+            self._child = struct.Struct('<Q')
+            self._child_offset = struct.calcsize('<{}{}'.format(2 * dim, coord))
+        self._max_entries = [self._capacity(False), self._capacity(True)]
+
+    # structs do not pickle, codecs go to worker processes by their options
+    def __reduce__(self):
+        return NodeCodec, (self._dim, self._node_size, self._checksum, self._compact, self._coord_type,
+                           self._key_size, self._aggregate)
+
+    def entry_size(self, is_leaf: bool) -> int:
+        return (self._leaf if is_leaf else self._non_leaf).size
+
+    def max_entries(self, is_leaf: bool) -> int:
+        return self._max_entries[is_leaf]
+
+    # bytes of a page not available for entries
+    def overhead(self, is_leaf: bool) -> int:
+        return self._HEADER.size + (0 if is_leaf else self._box.size) + (self._CRC.size if self._checksum else 0)
+
+    def _capacity(self, is_leaf: bool) -> int:
+        return max(0, (self._node_size - self.overhead(is_leaf)) // self.entry_size(is_leaf))
+
+    def encode(self, is_leaf: bool, entries: tuple) -> bytearray:
+        if len(entries) > self.max_entries(is_leaf):
+            raise ValueError
+
+        data = bytearray(self._node_size)
+        self._HEADER.pack_into(data, 0, self._LEAF if is_leaf else self._NON_LEAF, len(entries))
+        i = self._HEADER.size
+        if is_leaf:
+            for entry in entries:
+                self._leaf.pack_into(data, i, *entry.coord, entry.data_point)
+                i += self._leaf.size
+        elif self._compact:
+            self._encode_compact(data, i, entries)
+        else:
+            for entry in entries:
+                self._non_leaf.pack_into(data, i, *entry.first_coord, *entry.second_coord, entry.child_idx,
+                                         *self._extra(entry))
+                i += self._non_leaf.size
+        return self._seal(data)
+
+    # Boxes are rounded outwards to the grid, so they still contain their subtrees and searches
+    # only visit a few more nodes
+    def _encode_compact(self, data: bytearray, i: int, entries: tuple):
+        if not entries:
+            return
+        low = [min(entry.first_coord[d] for entry in entries) for d in range(self._dim)]
+        high = [max(entry.second_coord[d] for entry in entries) for d in range(self._dim)]
+        extent = [h - l for l, h in zip(low, high)]
+        self._box.pack_into(data, i, *low, *high)
+        i += self._box.size
+
+        cells = self._CELLS
+        # float boxes get one more cell on each side, which covers the rounding of the decoding
+        slack = 0 if self._integral else 1
+        for entry in entries:
+            first = [max(0, int((c - l) * cells // e) - slack) if e else 0
+                     for c, l, e in zip(entry.first_coord, low, extent)]
+            second = [min(cells, int(-((l - c) * cells // e)) + slack) if e else 0
+                      for c, l, e in zip(entry.second_coord, low, extent)]
+            self._non_leaf.pack_into(data, i, *first, *second, entry.child_idx, *self._extra(entry))
+            i += self._non_leaf.size
+
+    def _decode_compact(self, data, start: int, n: int) -> tuple:
+        if not n:
+            return ()
+        dim = self._dim
+        box = self._box.unpack_from(data, start)
+        low = box[:dim]
+        extent = [h - l for l, h in zip(low, box[dim:])]
+        start += self._box.size
+        end = start + n * self._non_leaf.size
+
+        cells = self._CELLS
+        if self._integral:
+            return tuple(NonLeafEntry([l + q * e // cells for q, l, e in zip(values[:dim], low, extent)],
+                                      [l - (-q * e // cells) for q, l, e in zip(values[dim:2 * dim], low, extent)],
+                                      values[2 * dim], *self._extra_values(values))
+                         for values in self._non_leaf.iter_unpack(memoryview(data)[start:end]))
+
+        # the node box edges are taken as stored, so they are exact
+        high = box[dim:]
+        return tuple(NonLeafEntry([l + q * e / cells if q else l for q, l, e in zip(values[:dim], low, extent)],
+                                  [l + q * e / cells if q != cells else h
+                                   for q, l, h, e in zip(values[dim:2 * dim], low, high, extent)],
+                                  values[2 * dim], *self._extra_values(values))
+                     for values in self._non_leaf.iter_unpack(memoryview(data)[start:end]))
+
+    # Adds offset to the child indices of an encoded non leaf page
+    def relocate(self, data: bytearray, offset: int) -> bytearray:
+        n = self._HEADER.unpack_from(data, 0)[1]
+        i = self._HEADER.size + self._box.size + self._child_offset
+        for _ in range(n):
+            self._child.pack_into(data, i, self._child.unpack_from(data, i)[0] + offset)
+            i += self._non_leaf.size
+        return self._seal(data)
+
+    # free slots are chained, the entry count holds the index of the next one plus one
+    def encode_free(self, next_free: Optional[int] = None) -> bytearray:
+        data = bytearray(self._node_size)
+        self._HEADER.pack_into(data, 0, self._FREE, 0 if next_free is None else next_free + 1)
+        return self._seal(data)
+
+    def is_free(self, data) -> bool:
+        return data[0] == self._FREE
+
+    def next_free(self, data) -> Optional[int]:
+        n = self._HEADER.unpack_from(data, 0)[1]
+        return n - 1 if n else None
+
+    # free slots decode as empty leaves
+    def decode(self, data) -> Tuple[bool, tuple]:
+        if self._checksum:
+            end = self._node_size - self._CRC.size
+            if zlib.crc32(memoryview(data)[:end]) != self._CRC.unpack_from(data, end)[0]:
+                raise ValueError('corrupted page')
+
+        node_type, n = self._HEADER.unpack_from(data, 0)
+        dim = self._dim
+        start = self._HEADER.size
+
+        if node_type == self._FREE:
+            return True, ()
+
+        if node_type == self._LEAF:
+            end = start + n * self._leaf.size
+            return True, tuple(LeafEntry(list(values[:dim]), values[dim])
+                               for values in self._leaf.iter_unpack(memoryview(data)[start:end]))
+
+        if self._compact:
+            return False, self._decode_compact(data, start, n)
+
+        end = start + n * self._non_leaf.size
+        return False, tuple(NonLeafEntry(list(values[:dim]), list(values[dim:2 * dim]), values[2 * dim],
+                                         *self._extra_values(values))
+                            for values in self._non_leaf.iter_unpack(memoryview(data)[start:end]))
+
+    # fields of a non leaf entry after the child index
+    def _extra(self, entry: NonLeafEntry) -> tuple:
+        count = (entry.count,) if self._aggregate else ()
+        if not self._key_size:
+            return count
+        return count + (entry.lhv.to_bytes(self._key_size, byteorder='little', signed=False),)
+
+    # lhv and count of a decoded non leaf entry
+    def _extra_values(self, values: tuple) -> Tuple[Optional[int], Optional[int]]:
+        lhv = int.from_bytes(values[-1], byteorder='little', signed=False) if self._key_size else None
+        count = values[2 * self._dim + 1] if self._aggregate else None
+        return lhv, count
+
+    def _seal(self, data: bytearray) -> bytearray:
+        if self._checksum:
+            end = self._node_size - self._CRC.size
+            self._CRC.pack_into(data, end, zlib.crc32(memoryview(data)[:end]))
+        return data
@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+from .node import Node
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# coordinates up to this magnitude and their differences are exact in float64
+_EXACT_LIMIT = 2 ** 52
+_EXACT_DIST_LIMIT = 2 ** 53
+
+
+class NodeColumns:
+    # below this many entries the loops in Python are faster than building and scanning arrays
+    MIN_ENTRIES = 32
+    # points whose distances within computes at once
+    BLOCK_POINTS = 256
+
+    def __init__(self, mins, maxs, integral: bool = True):
+        self.mins = mins
+        self.maxs = maxs
+        self.integral = integral
+
+    # points is the number of points the columns are used for at once
+    @classmethod
+    def from_node(cls, node: Node, integral: bool = True, points: int = 1) -> Optional['NodeColumns']:
+        if numpy is None or len(node.entries) * points < cls.MIN_ENTRIES:
+            return None
+
+        boxes = [entry.get_bounding_box() for entry in node.entries]
+        try:
+            mins = numpy.array([box[0] for box in boxes], dtype=numpy.float64)
+            maxs = numpy.array([box[1] for box in boxes], dtype=numpy.float64)
+        except OverflowError:
+            return None
+        if integral and max(numpy.abs(mins).max(), numpy.abs(maxs).max()) > _EXACT_LIMIT:
+            return None
+        return cls(mins, maxs, integral)
+
+    # Indices of entries overlapping the box
+    def overlapping(self, box: Tuple[list, list]) -> List[int]:
+        mask = numpy.logical_and(self.mins <= box[1], self.maxs >= box[0]).all(axis=1)
+        return numpy.flatnonzero(mask).tolist()
+
+    # Squared distances from the point to every entry, None if integer distances cannot be computed exactly
+    def min_distances(self, point: List[int]) -> Optional[List[int]]:
+        if self.integral and max(abs(x) for x in point) > _EXACT_LIMIT:
+            return None
+
+        p = numpy.array(point, dtype=numpy.float64)
+        diff = numpy.maximum(self.mins - p, 0) + numpy.maximum(p - self.maxs, 0)
+        dist = (diff * diff).sum(axis=1)
+        if not self.integral:
+            return dist.tolist()
+        if dist.max() >= _EXACT_DIST_LIMIT:
+            return None
+        return [int(x) for x in dist.tolist()]
+
+    # Per point the indices of entries not farther than its bound (None keeps all) with their squared
+    # distances, None if integer distances cannot be computed exactly; points go in blocks of BLOCK_POINTS.
+    # With nearest, entries farther than the nearest-th closest one are dropped too, ties are kept
+    def within(self, points: List[List[int]], bounds: list,
+               nearest: Optional[int] = None) -> Optional[List[Tuple[List[int], list]]]:
+        if self.integral and max(abs(x) for point in points for x in point) > _EXACT_LIMIT:
+            return None
+
+        result = list()
+        for start in range(0, len(points), self.BLOCK_POINTS):
+            p = numpy.array(points[start:start + self.BLOCK_POINTS], dtype=numpy.float64)[:, None, :]
+            diff = numpy.maximum(self.mins - p, 0) + numpy.maximum(p - self.maxs, 0)
+            dist = (diff * diff).sum(axis=2)
+            if self.integral and dist.max() >= _EXACT_DIST_LIMIT:
+                return None
+            for row, bound in zip(dist, bounds[start:start + self.BLOCK_POINTS]):
+                if nearest is not None and nearest < len(row):
+                    kth = numpy.partition(row, nearest - 1)[nearest - 1]
+                    bound = kth if bound is None else min(bound, kth)
+                indices = numpy.flatnonzero(row <= bound) if bound is not None else numpy.arange(len(row))
+                values = row[indices].tolist()
+                result.append((indices.tolist(), [int(x) for x in values] if self.integral else values))
+        return result
+
+
+class ColumnCache:
+    CAPACITY = 4096
+
+    def __init__(self, capacity: int = CAPACITY, integral: bool = True):
+        self._capacity = capacity
+        self._integral = integral
+        # node index -> (entries, columns), stale once the storage hands out different entries
+        self._nodes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, index: int, node: Node, points: int = 1) -> Optional[NodeColumns]:
+        if len(node.entries) * points < NodeColumns.MIN_ENTRIES:
+            return None
+        if type(node.entries) is not tuple:
+            return NodeColumns.from_node(node, self._integral, points)
+
+        with self._lock:
+            cached = self._nodes.get(index)
+            if cached is not None and cached[0] is node.entries:
+                self._nodes.move_to_end(index)
+                return cached[1]
+
+        columns = NodeColumns.from_node(node, self._integral, points)
+        with self._lock:
+            self._nodes[index] = (node.entries, columns)
+            self._nodes.move_to_end(index)
+            if len(self._nodes) > self._capacity:
+                self._nodes.popitem(last=False)
+        return columns
+
+    @staticmethod
+    def available() -> bool:
+        return numpy is not None
@@ -0,0 +1,92 @@
+import struct
+from enum import Enum
+from typing import List
+
+
+class CoordType(Enum):
+    INT32 = 1
+    INT64 = 2
+    FLOAT32 = 3
+    FLOAT64 = 4
+
+    @classmethod
+    def from_str(cls, value: str):
+        if value == 'int32':
+            return cls.INT32
+
+        if value == 'int64':
+            return cls.INT64
+
+        if value == 'float32':
+            return cls.FLOAT32
+
+        if value == 'float64':
+            return cls.FLOAT64
+
+        return None
+
+    def to_str(self):
+        return self.name.lower()
+
+    # struct format of one coordinate
+    def get_format(self) -> str:
+        return _FORMATS[self]
+
+    # 8B format able to hold any coordinate of the type and any box computed from them
+    def get_wide_format(self) -> str:
+        return 'q' if self.is_integral() else 'd'
+
+    def get_size(self) -> int:
+        return _SIZES[self]
+
+    def get_bits(self) -> int:
+        return 8 * _SIZES[self]
+
+    def is_integral(self) -> bool:
+        return self in _BOUNDS
+
+    # integer coordinates are cells, so a box covers one more unit than its side
+    def get_cell(self) -> int:
+        return 1 if self.is_integral() else 0
+
+    # Brings a point to the values the type stores, so points read back from a file equal the inserted ones
+    def convert(self, coord: List) -> list:
+        bounds = _BOUNDS.get(self)
+        if bounds is not None:
+            low, high = bounds
+            for x in coord:
+                if not low <= x < high:
+                    raise ValueError
+            return list(coord)
+        if self is CoordType.FLOAT32:
+            points = _float32_struct(len(coord))
+            return list(points.unpack(points.pack(*coord)))
+        return [float(x) for x in coord]
+
+    # Maps a point to unsigned integers of get_bits() bits in the same order, floats by their bit patterns
+    def to_grid(self, coord: List) -> List[int]:
+        bits = self.get_bits()
+        sign = 1 << (bits - 1)
+        if self.is_integral():
+            return [x + sign for x in coord]
+
+        fmt = '<{}'.format(len(coord))
+        raw = struct.unpack(fmt + ('I' if bits == 32 else 'Q'), struct.pack(fmt + self.get_format(), *coord))
+        return [(~x & (2 * sign - 1)) if x & sign else x | sign for x in raw]
+
+
+# per type tables, the methods above run for every point
+_FORMATS = {CoordType.INT32: 'i', CoordType.INT64: 'q', CoordType.FLOAT32: 'f', CoordType.FLOAT64: 'd'}
+_SIZES = {coord_type: struct.calcsize('<' + fmt) for coord_type, fmt in _FORMATS.items()}
+# coordinates of integer types lie in [low, high)
+_BOUNDS = {coord_type: (-2 ** (8 * _SIZES[coord_type] - 1), 2 ** (8 * _SIZES[coord_type] - 1))
+           for coord_type in (CoordType.INT32, CoordType.INT64)}
+# float32 structs by the number of coordinates
+_FLOAT32_STRUCTS = dict()
+
+
+def _float32_struct(dim: int) -> struct.Struct:
+    points = _FLOAT32_STRUCTS.get(dim)
+    if points is None:
+        points = _FLOAT32_STRUCTS[dim] = struct.Struct('<{}f'.format(dim))
+    return points
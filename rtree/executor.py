@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Tuple, Optional
+from .rtree import RTree
+
+
+class QueryExecutor:
+    # Runs queries of one tree on a thread pool, the tree must not be modified meanwhile
+    def __init__(self, tree: RTree, max_workers: Optional[int] = None):
+        self._tree = tree
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit_range(self, search_box: Tuple[list, list]) -> Future:
+        return self._pool.submit(self._tree.search_range, search_box)
+
+    def submit_knn(self, search_around: List[int], number_of_entries: int) -> Future:
+        return self._pool.submit(self._tree.search_knn, search_around, number_of_entries)
+
+    def search_range(self, search_boxes: List[Tuple[list, list]]) -> List[List[Tuple[List[int], int]]]:
+        return list(self._pool.map(self._tree.search_range, search_boxes))
+
+    def search_knn(self, points: List[List[int]], number_of_entries: int) -> List[List[Tuple[List[int], int]]]:
+        return list(self._pool.map(lambda point: self._tree.search_knn(point, number_of_entries), points))
+
+    def close(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
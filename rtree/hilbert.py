@@ -0,0 +1,41 @@
+from typing import List
+
+
+# Position of the point on the Hilbert curve through a grid of 2^bits cells per dimension,
+# coordinates must be non-negative and smaller than 2^bits (J. Skilling, Programming the Hilbert curve)
+def hilbert_key(point: List[int], bits: int) -> int:
+    x = list(point)
+    n = len(x)
+    top = 1 << (bits - 1)
+
+    # inverse undo of the rotations and reflections
+    q = top
+    while q > 1:
+        p = q - 1
+        for i in range(n):
+            if x[i] & q:
+                x[0] ^= p
+            else:
+                t = (x[0] ^ x[i]) & p
+                x[0] ^= t
+                x[i] ^= t
+        q >>= 1
+
+    # gray encode
+    for i in range(1, n):
+        x[i] ^= x[i - 1]
+    t = 0
+    q = top
+    while q > 1:
+        if x[n - 1] & q:
+            t ^= q - 1
+        q >>= 1
+    for i in range(n):
+        x[i] ^= t
+
+    # interleaves the transposed bits, the most significant bits of all dimensions first
+    key = 0
+    for b in range(bits - 1, -1, -1):
+        for i in range(n):
+            key = (key << 1) | ((x[i] >> b) & 1)
+    return key
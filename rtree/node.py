@@ -1,16 +1,22 @@
-from typing import Tuple
+from typing import Tuple, Optional
 
 
 class NonLeafEntry:
-    def __init__(self, first_coord: list, second_coord: list, child_idx: int):
+    # lhv is the largest Hilbert key in the subtree, kept only by Hilbert trees,
+    # count is the number of data points in the subtree, kept only by aggregate trees
+    def __init__(self, first_coord: list, second_coord: list, child_idx: int, lhv: Optional[int] = None,
+                 count: Optional[int] = None):
         self.first_coord = first_coord
         self.second_coord = second_coord
         self.child_idx = child_idx
+        self.lhv = lhv
+        self.count = count
 
     def __eq__(self, other):
         if not isinstance(other, NonLeafEntry):
             return False
-        return self.first_coord == other.first_coord and self.second_coord == other.second_coord and self.child_idx == other.child_idx
+        return self.first_coord == other.first_coord and self.second_coord == other.second_coord and self.child_idx == other.child_idx \
+            and self.lhv == other.lhv and self.count == other.count
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -23,6 +29,8 @@ class LeafEntry:
     def __init__(self, coord: list, data_point: int):
         self.coord = coord
         self.data_point = data_point
+        # Hilbert key of coord, computed by Hilbert trees when first needed
+        self.hilbert_key = None
 
     def get_bounding_box(self) -> Tuple[list, list]:
         return self.coord, self.coord
@@ -52,7 +60,13 @@ class Node:
     def get_max_size(self) -> int:
         return self._max_size
 
+    # entries handed out by a storage are a shared tuple, they are copied on the first write
+    def _own_entries(self) -> None:
+        if type(self.entries) is tuple:
+            self.entries = list(self.entries)
+
     def add_entry(self, entry) -> bool:
+        self._own_entries()
         if len(self.entries) == self._max_size:
             self.entries.append(entry)
             return False
@@ -60,6 +74,14 @@ class Node:
             self.entries.append(entry)
             return True
 
+    def insert_entry(self, entry, idx: int) -> None:
+        self._own_entries()
+        self.entries.insert(idx, entry)
+
     def set_entry(self, entry, idx: int) -> None:
+        self._own_entries()
         self.entries[idx] = entry
-        pass
+
+    def remove_entry(self, idx: int) -> None:
+        self._own_entries()
+        del self.entries[idx]
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict, List, Callable
+
+
+class QueryCache:
+    # results of range and kNN queries, least recently used first, bounded by an estimate of their size
+    MAX_BYTES = 16 * 1024 * 1024
+    # estimated bytes of a cached query and of one coordinate or data point of its result
+    _QUERY_BYTES = 256
+    _VALUE_BYTES = 32
+
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        if max_bytes < 1:
+            raise ValueError
+
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (result, affected, size), affected tells whether a point changes the result
+        self._results = OrderedDict()
+        self._bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get_max_bytes(self) -> int:
+        return self._max_bytes
+
+    @staticmethod
+    def range_key(search_box: Tuple[list, list]) -> tuple:
+        return 'range', tuple(search_box[0]), tuple(search_box[1])
+
+    @staticmethod
+    def knn_key(search_around: List[int], number_of_entries: int) -> tuple:
+        return 'knn', tuple(search_around), number_of_entries
+
+    # Returns a copy of the cached result, None on a miss
+    def get(self, key: tuple) -> Optional[List[Tuple[List[int], int]]]:
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            self._results.move_to_end(key)
+            return [(list(coord), data) for coord, data in cached[0]]
+
+    def put(self, key: tuple, result: List[Tuple[List[int], int]], affected: Callable[[List[int]], bool]):
+        size = self._QUERY_BYTES + self._VALUE_BYTES * sum(len(coord) + 1 for coord, _ in result)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._results:
+                self._bytes -= self._results.pop(key)[2]
+            self._results[key] = (tuple((tuple(coord), data) for coord, data in result), affected, size)
+            self._bytes += size
+
+            while self._bytes > self._max_bytes:
+                _, (_, _, old_size) = self._results.popitem(last=False)
+                self._bytes -= old_size
+                self._evictions += 1
+
+    # Drops the results a point inserted or deleted at coord could change
+    def invalidate(self, coord: List[int]):
+        with self._lock:
+            for key in [key for key, (_, affected, _) in self._results.items() if affected(coord)]:
+                self._bytes -= self._results.pop(key)[2]
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += len(self._results)
+            self._results.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions,
+                    'invalidations': self._invalidations, 'entries': len(self._results), 'bytes': self._bytes}
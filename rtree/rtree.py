@@ -1,16 +1,26 @@
 import sys
 import math
-from itertools import combinations
+import heapq
+from itertools import combinations, repeat, chain
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from collections import deque
 from .split_type import RTreeSplitType
-from .storage import Storage, MemoryStorage, DiskStorage
+from .sync_policy import SyncPolicy
+from .coord_type import CoordType
+from .storage import Storage, MemoryStorage, DiskStorage, MappedDiskStorage
 from .node import Node, LeafEntry, NonLeafEntry
-from typing import Tuple, List
+from .columnar import ColumnCache
+from .codec import NodeCodec
+from .hilbert import hilbert_key
+from .query_cache import QueryCache
+from typing import Tuple, List, Iterable, Iterator, Optional, Callable, Dict
 
 
-def bounding_box_area(box: Tuple[list, list]) -> int:
+# cell is 1 for integer coordinates, where a box covers its edges, 0 for floats
+def bounding_box_area(box: Tuple[list, list], cell: int = 1) -> int:
     area = 1
-    dimensions = (abs(x - y) + 1 for x, y in zip(box[0], box[1]))
+    dimensions = (abs(x - y) + cell for x, y in zip(box[0], box[1]))
     for dimension in dimensions:
         area *= dimension
     return area
@@ -25,8 +35,8 @@ def min_bounding_box(first: Tuple[list, list], second: Tuple[list, list]) -> Tup
     return first_coords, second_coords
 
 
-def two_box_area(first: Tuple[list, list], second: Tuple[list, list]) -> int:
-    return bounding_box_area(min_bounding_box(first, second))
+def two_box_area(first: Tuple[list, list], second: Tuple[list, list], cell: int = 1) -> int:
+    return bounding_box_area(min_bounding_box(first, second), cell)
 
 
 def overlaps(first: Tuple[list, list], second: Tuple[list, list]) -> bool:
@@ -43,24 +53,67 @@ def is_in(point: List[int], box: Tuple[list, list]) -> bool:
     return True
 
 
-def overlaps_distance(point: List[int], distance: int, box: Tuple[list, list]) -> bool:
-    u = [max(0, point[i] - box[1][i]) for i in range(len(point))]
-    v = [max(0, box[0][i] - point[i]) for i in range(len(point))]
+def min_distance(point: List[int], box: Tuple[list, list]) -> int:
+    # squared distance from the point to the closest point of the box, products round the same
+    # as the ones of the columns, which squares of floats do not
+    dist = 0
+    for x, coord in enumerate(point):
+        if coord < box[0][x]:
+            diff = box[0][x] - coord
+            dist += diff * diff
+        elif coord > box[1][x]:
+            diff = coord - box[1][x]
+            dist += diff * diff
+    return dist
 
-    dist = math.sqrt(sum([x * x + y * y for x, y in zip(u, v)]))
 
-    return dist <= distance
+def box_distance(first: Tuple[list, list], second: Tuple[list, list]) -> int:
+    # squared distance between the closest points of the boxes, 0 if they overlap
+    dist = 0
+    for x in range(len(first[0])):
+        if first[1][x] < second[0][x]:
+            dist += (second[0][x] - first[1][x]) ** 2
+        elif second[1][x] < first[0][x]:
+            dist += (first[0][x] - second[1][x]) ** 2
+    return dist
+
+
+def plane_sweep(first: list, second: list, distance, max_dist) -> Iterator[tuple]:
+    # pairs of entries closer than distance, max_dist is its square; both lists are sorted
+    # by the lower edge in the first dimension and every entry is only compared to the entries
+    # of the other list starting within distance of its upper edge
+    first = sorted(first, key=lambda e: e.get_bounding_box()[0][0])
+    second = sorted(second, key=lambda e: e.get_bounding_box()[0][0])
+    i = j = 0
+    while i < len(first) and j < len(second):
+        first_box = first[i].get_bounding_box()
+        second_box = second[j].get_bounding_box()
+        if first_box[0][0] <= second_box[0][0]:
+            k = j
+            while k < len(second) and second[k].get_bounding_box()[0][0] <= first_box[1][0] + distance:
+                if box_distance(first_box, second[k].get_bounding_box()) <= max_dist:
+                    yield first[i], second[k]
+                k += 1
+            i += 1
+        else:
+            k = i
+            while k < len(first) and first[k].get_bounding_box()[0][0] <= second_box[1][0] + distance:
+                if box_distance(first[k].get_bounding_box(), second_box) <= max_dist:
+                    yield first[k], second[j]
+                k += 1
+            j += 1
 
 
-def pick_next(entries_left: deque, first_bounding_rect: Tuple[list, list], second_bounding_rect: Tuple[list, list]):
+def pick_next(entries_left: deque, first_bounding_rect: Tuple[list, list], second_bounding_rect: Tuple[list, list],
+              cell: int = 1):
     max_dif_size = -1
     max_dif_entry = entries_left.popleft()
     for i in range(len(entries_left)):
         check_entry = entries_left.popleft()
-        first_dif = two_box_area(check_entry.get_bounding_box(), first_bounding_rect) - \
-            bounding_box_area(first_bounding_rect)
-        second_dif = two_box_area(check_entry.get_bounding_box(), second_bounding_rect) - \
-            bounding_box_area(second_bounding_rect)
+        first_dif = two_box_area(check_entry.get_bounding_box(), first_bounding_rect, cell) - \
+            bounding_box_area(first_bounding_rect, cell)
+        second_dif = two_box_area(check_entry.get_bounding_box(), second_bounding_rect, cell) - \
+            bounding_box_area(second_bounding_rect, cell)
         dif = abs(first_dif - second_dif)
         if dif > max_dif_size:
             max_dif_size = dif
@@ -81,29 +134,307 @@ def new_parent_entry(node: Node, idx: int) -> NonLeafEntry:
     return node_new_entry
 
 
+def intersection_area(first: Tuple[list, list], second: Tuple[list, list], cell: int = 1) -> int:
+    area = 1
+    for x in range(len(first[0])):
+        side = min(first[1][x], second[1][x]) - max(first[0][x], second[0][x]) + cell
+        if side <= 0:
+            return 0
+        area *= side
+    return area
+
+
+def box_margin(box: Tuple[list, list], cell: int = 1) -> int:
+    return sum(abs(x - y) + cell for x, y in zip(box[0], box[1]))
+
+
+def group_bounding_box(entries: list) -> Tuple[list, list]:
+    bounding_box = entries[0].get_bounding_box()
+    for entry in entries[1:]:
+        bounding_box = min_bounding_box(bounding_box, entry.get_bounding_box())
+    return bounding_box
+
+
+def box_center(box: Tuple[list, list], dim: int) -> int:
+    # doubled center, keeps the sort key integral
+    return box[0][dim] + box[1][dim]
+
+
+def str_pack(entries: list, capacity: int, dimensions: int, dim: int = 0) -> List[list]:
+    if dim == dimensions - 1 or len(entries) <= capacity:
+        entries = sorted(entries, key=lambda e: box_center(e.get_bounding_box(), dim))
+        return [entries[i:i + capacity] for i in range(0, len(entries), capacity)]
+
+    pages = math.ceil(len(entries) / capacity)
+    slabs = math.ceil(pages ** (1 / (dimensions - dim)))
+    slab_size = capacity * math.ceil(pages / slabs)
+
+    entries = sorted(entries, key=lambda e: box_center(e.get_bounding_box(), dim))
+    groups = list()
+    for i in range(0, len(entries), slab_size):
+        groups.extend(str_pack(entries[i:i + slab_size], capacity, dimensions, dim + 1))
+    return groups
+
+
+def pack_pages(coords: array, data_points: List[int], coord_type: CoordType, codec: NodeCodec,
+               capacities: Tuple[int, int], levels: int, aggregate: bool = False) -> List[List[bytearray]]:
+    # Packs the points, given as their coordinates one after another, into the given number of levels
+    # and returns the encoded pages level by level. Non leaf pages point to their children by the position
+    # among all the returned pages. Runs in worker processes.
+    dimensions = len(coords) // len(data_points)
+    entries = [LeafEntry(coord_type.convert(coords[i * dimensions:(i + 1) * dimensions]), data_point)
+               for i, data_point in enumerate(data_points)]
+    packed = list()
+    is_leaf = True
+    start = 0
+    for _ in range(levels):
+        pages = list()
+        parent_entries = list()
+        for group in str_pack(entries, capacities[0 if is_leaf else 1], dimensions):
+            node = Node(is_leaf, len(group))
+            node.entries = group
+            parent_entry = new_parent_entry(node, start + len(pages))
+            if aggregate:
+                parent_entry.count = len(group) if is_leaf else sum(entry.count for entry in group)
+            parent_entries.append(parent_entry)
+            pages.append(codec.encode(is_leaf, group))
+        packed.append(pages)
+        start += len(pages)
+        entries = parent_entries
+        is_leaf = False
+    return packed
+
+
 class RTree:
+    _RSTAR_OVERLAP_CANDIDATES = 32
+    # bits per coordinate of the curve insert_many sorts its batches by
+    _BATCH_ORDER_BITS = 16
+    # nodes of a split batch an entry may go to, the sorted batch moves on from the older ones
+    _BATCH_CANDIDATES = 8
+    # fill of the nodes a heavily overflowing node is packed into, with room left for later inserts
+    _BATCH_FILL = 0.7
+    # nodes with fewer entries than this part of their capacity are dissolved by delete
+    _MIN_FILL = 0.4
+
     def __init__(self, storage: Storage):
         self._storage = storage
+        self._coord_type = storage.get_coord_type()
+        self._cell = self._coord_type.get_cell()
+        # per node coordinate arrays for vectorized search, only with numpy
+        self._columns = ColumnCache(integral=self._coord_type.is_integral()) if ColumnCache.available() else None
+        # results of repeated queries, off unless enabled
+        self._query_cache = None
+
+        # files without valid statistics get them from the nodes, the entry count only when asked for
+        if storage.get_height() is None:
+            height = 0
+            node = storage.get_node(0)
+            while not node.is_leaf():
+                node = storage.get_node(node.entries[0].child_idx)
+                height += 1
+            storage.set_height(height)
+            self._update_root_box()
 
     @classmethod
-    def from_file(cls, filename: str):
-        return cls(DiskStorage(filename))
+    def from_file(cls, filename: str, cache_pages: int = DiskStorage.CACHE_PAGES, cache_bytes: Optional[int] = None,
+                  use_mmap: bool = False, wal: bool = False, group_commit: int = 1,
+                  sync_policy: Optional[SyncPolicy] = None, pinned_levels: Optional[int] = None,
+                  pinned_bytes: Optional[int] = None):
+        storage_type = MappedDiskStorage if use_mmap else DiskStorage
+        return cls(storage_type(filename, cache_pages=cache_pages, cache_bytes=cache_bytes,
+                                wal=wal, group_commit=group_commit, sync_policy=sync_policy,
+                                pinned_levels=pinned_levels, pinned_bytes=pinned_bytes))
 
     @classmethod
-    def create_in_file(cls, filename: str, dimensions: int, node_size: int, split_type: RTreeSplitType):
-        DiskStorage.write_header(filename, dimensions, node_size, split_type)
-        return cls.from_file(filename)
+    def create_in_file(cls, filename: str, dimensions: int, node_size: int, split_type: RTreeSplitType,
+                       cache_pages: int = DiskStorage.CACHE_PAGES, cache_bytes: Optional[int] = None,
+                       use_mmap: bool = False, wal: bool = False, group_commit: int = 1,
+                       sync_policy: Optional[SyncPolicy] = None, compact: bool = False,
+                       coord_type: CoordType = CoordType.INT64, aggregate: bool = False,
+                       pinned_levels: Optional[int] = None, pinned_bytes: Optional[int] = None):
+        DiskStorage.write_header(filename, dimensions, node_size, split_type, compact=compact, coord_type=coord_type,
+                                 aggregate=aggregate)
+        return cls.from_file(filename, cache_pages, cache_bytes, use_mmap, wal, group_commit, sync_policy,
+                             pinned_levels, pinned_bytes)
 
     @classmethod
-    def create_in_memory(cls, dimensions: int, node_size: int, split_type: RTreeSplitType):
-        return cls(MemoryStorage(dimensions, node_size, split_type))
+    def create_in_memory(cls, dimensions: int, node_size: int, split_type: RTreeSplitType,
+                         coord_type: CoordType = CoordType.INT64, aggregate: bool = False):
+        return cls(MemoryStorage(dimensions, node_size, split_type, coord_type, aggregate))
+
+    @classmethod
+    def bulk_load(cls, points: Iterable[Tuple[List[int], int]], dimensions: int, node_size: int,
+                  split_type: RTreeSplitType, fill_factor: float = 1.0, workers: Optional[int] = None,
+                  coord_type: CoordType = CoordType.INT64, aggregate: bool = False):
+        tree = cls.create_in_memory(dimensions, node_size, split_type, coord_type, aggregate)
+        tree._bulk_load(points, fill_factor, workers)
+        return tree
+
+    @classmethod
+    def bulk_load_in_file(cls, filename: str, points: Iterable[Tuple[List[int], int]], dimensions: int,
+                          node_size: int, split_type: RTreeSplitType, fill_factor: float = 1.0,
+                          workers: Optional[int] = None, compact: bool = False,
+                          coord_type: CoordType = CoordType.INT64, aggregate: bool = False):
+        tree = cls.create_in_file(filename, dimensions, node_size, split_type, compact=compact, coord_type=coord_type,
+                                  aggregate=aggregate)
+        tree._bulk_load(points, fill_factor, workers)
+        return tree
+
+    def _bulk_load(self, points: Iterable[Tuple[List[int], int]], fill_factor: float, workers: Optional[int] = None):
+        if not 0 < fill_factor <= 1:
+            raise ValueError
+
+        points = list(points)
+        point_count = len(points)
+        is_leaf = True
+        height = 0
+        dimensions = self.get_dimensions()
+        hilbert = self._storage.get_split_type() == RTreeSplitType.HILBERT
+
+        if not hilbert and workers is not None and workers > 1 and point_count > self._storage._max_entries(True):
+            entries, height = self._parallel_pack(points, fill_factor, workers)
+            is_leaf = False
+        else:
+            entries = [LeafEntry(self._coord_type.convert(coord), data) for coord, data in points]
+        if hilbert:
+            # leaves follow the Hilbert curve and are written in its order, every level keeps it
+            keys = [self._hilbert_key(entry) for entry in entries]
+            entries = [entries[i] for i in sorted(range(len(entries)), key=keys.__getitem__)]
+
+        # packs one level at a time until everything left fits into the root
+        while len(entries) > self._storage._max_entries(is_leaf):
+            capacity = max(2, math.floor(self._storage._max_entries(is_leaf) * fill_factor))
+            parent_entries = list()
+            if hilbert:
+                groups = [entries[i:i + capacity] for i in range(0, len(entries), capacity)]
+            else:
+                groups = str_pack(entries, capacity, dimensions)
+            for group in groups:
+                node = Node(is_leaf, self._storage._max_entries(is_leaf))
+                node.entries = group
+                idx = self._storage.add_node(node)
+                parent_entries.append(self._parent_entry(node, idx))
+            entries = parent_entries
+            is_leaf = False
+            height += 1
+
+        root = Node(is_leaf, self._storage._max_entries(is_leaf))
+        root.entries = entries
+        self._storage.set_node(0, root)
+        self._storage.set_height(height)
+        self._storage.set_entry_count(point_count)
+        if self._query_cache is not None:
+            self._query_cache.clear()
+        self._commit()
+
+    # Returns the entries of the subtree roots and the height of the subtrees. Workers get the points
+    # of their slab as flat arrays and return encoded pages, which are only moved to their indices here
+    def _parallel_pack(self, points: List[Tuple[List[int], int]], fill_factor: float,
+                       workers: int) -> Tuple[List[NonLeafEntry], int]:
+        capacities = (max(2, math.floor(self._storage._max_entries(True) * fill_factor)),
+                      max(2, math.floor(self._storage._max_entries(False) * fill_factor)))
+
+        # slabs along the first dimension made of whole leaves, one per worker
+        points = sorted(points, key=lambda point: point[0][0])
+        slab_size = capacities[0] * math.ceil(math.ceil(len(points) / capacities[0]) / workers)
+        slabs = [points[i:i + slab_size] for i in range(0, len(points), slab_size)]
+
+        # all subtrees get the same height, as long as the smallest slab still fills its upper nodes
+        levels = 1
+        nodes = math.ceil(len(slabs[-1]) / capacities[0])
+        while nodes > capacities[1]:
+            nodes = math.ceil(nodes / capacities[1])
+            levels += 1
+
+        dimensions = self.get_dimensions()
+        coords = list()
+        for slab in slabs:
+            try:
+                slab_coords = array(self._coord_type.get_wide_format(), chain.from_iterable(coord for coord, _ in slab))
+            except OverflowError:
+                raise ValueError
+            if len(slab_coords) != dimensions * len(slab):
+                raise ValueError
+            coords.append(slab_coords)
+
+        codec = self._storage.get_codec()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            subtrees = list(pool.map(pack_pages, coords, [[data for _, data in slab] for slab in slabs],
+                                     repeat(self._coord_type), repeat(codec), repeat(capacities), repeat(levels),
+                                     repeat(self._storage.is_aggregate())))
+
+        # pages of a subtree are stored one after another, child positions become node indices
+        top_entries = list()
+        for subtree in subtrees:
+            start = self._storage.count()
+            pages = list(subtree[0])
+            for level in subtree[1:]:
+                pages.extend(codec.relocate(page, start) for page in level)
+            self._storage.add_pages(pages)
+            for idx in range(start + len(pages) - len(subtree[-1]), start + len(pages)):
+                top_entries.append(self._parent_entry(self._storage.get_node(idx), idx))
+        return top_entries, levels
 
     def get_dimensions(self) -> int:
         return self._storage.get_dim()
 
-    def _choose_leaf(self, node_idx: int, new_entry: LeafEntry):
+    # Keeps the results of search_range and search_knn, a changed point drops only the results it could affect
+    def enable_query_cache(self, max_bytes: int = QueryCache.MAX_BYTES):
+        self._query_cache = QueryCache(max_bytes)
+
+    def disable_query_cache(self):
+        self._query_cache = None
+
+    # hits, misses, evictions, invalidations, number of cached results and their estimated bytes
+    def get_query_cache_stats(self) -> Optional[Dict[str, int]]:
+        return self._query_cache.get_stats() if self._query_cache is not None else None
+
+    def _invalidate(self, coord: List[int]):
+        if self._query_cache is not None:
+            self._query_cache.invalidate(coord)
+
+    def flush(self):
+        self._storage.flush()
+
+    def close(self):
+        self._storage.close()
+
+    # Number of data points
+    def __len__(self) -> int:
+        if self._storage.get_entry_count() is None:
+            count = 0
+            node_queue = deque([0])
+            while node_queue:
+                node = self._storage.get_node(node_queue.popleft())
+                if node.is_leaf():
+                    count += len(node.entries)
+                else:
+                    node_queue.extend(entry.child_idx for entry in node.entries)
+            self._storage.set_entry_count(count)
+        return self._storage.get_entry_count()
+
+    # Ends an operation, the statistics go to the storage with it
+    def _commit(self, entry_change: int = 0):
+        count = self._storage.get_entry_count()
+        if entry_change and count is not None:
+            self._storage.set_entry_count(count + entry_change)
+        self._update_root_box()
+        self._storage.commit()
+
+    def _update_root_box(self):
+        root = self._storage.get_node(0)
+        self._storage.set_root_box(group_bounding_box(root.entries) if root.entries else None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # depth is the number of levels left to descend, None goes down to a leaf
+    def _choose_leaf(self, node_idx: int, new_entry, depth: Optional[int] = None):
         node = self._storage.get_node(node_idx)
-        if node.is_leaf():
+        if node.is_leaf() if depth is None else depth == 0:
             if node.add_entry(new_entry):
                 self._storage.set_node(node_idx, node)
                 return node_idx, node
@@ -115,26 +446,28 @@ class RTree:
             min_entry_idx = -1
             for idx, entry in enumerate(node.entries):
                 new_bounding_box = min_bounding_box(entry.get_bounding_box(), new_entry.get_bounding_box())
-                new_box_diff = bounding_box_area(new_bounding_box)-bounding_box_area(entry.get_bounding_box())
+                new_box_diff = bounding_box_area(new_bounding_box, self._cell) - \
+                    bounding_box_area(entry.get_bounding_box(), self._cell)
 
                 if new_box_diff < min_diff:
                     min_entry_idx = idx
                     min_diff = new_box_diff
                     min_entry = entry
                 elif new_box_diff == min_diff:
-                    if bounding_box_area(entry.get_bounding_box()) < bounding_box_area(min_entry.get_bounding_box()):
+                    if bounding_box_area(entry.get_bounding_box(), self._cell) < \
+                            bounding_box_area(min_entry.get_bounding_box(), self._cell):
                         min_entry_idx = idx
                         min_diff = new_box_diff
                         min_entry = entry
 
-            idx, ret = self._choose_leaf(min_entry.child_idx, new_entry)
+            idx, ret = self._choose_leaf(min_entry.child_idx, new_entry, None if depth is None else depth - 1)
             if type(ret) is tuple:
                 self._storage.set_node(min_entry.child_idx, ret[0])
-                first_node_new_entry = new_parent_entry(ret[0], min_entry.child_idx)
-                node.entries[min_entry_idx] = first_node_new_entry
+                first_node_new_entry = self._parent_entry(ret[0], min_entry.child_idx)
+                node.set_entry(first_node_new_entry, min_entry_idx)
 
                 second_node_idx = self._storage.add_node(ret[1])
-                second_node_new_entry = new_parent_entry(ret[1], second_node_idx)
+                second_node_new_entry = self._parent_entry(ret[1], second_node_idx)
 
                 if node.add_entry(second_node_new_entry):
                     self._storage.set_node(node_idx, node)
@@ -142,8 +475,8 @@ class RTree:
                 else:
                     return node_idx, self._split_node(node)
             else:
-                node_new_entry = new_parent_entry(ret, min_entry.child_idx)
-                node.entries[min_entry_idx] = node_new_entry
+                node_new_entry = self._parent_entry(ret, min_entry.child_idx)
+                node.set_entry(node_new_entry, min_entry_idx)
                 self._storage.set_node(node_idx, node)
                 return node_idx, node
         pass
@@ -157,12 +490,14 @@ class RTree:
         return entries_left
 
     @staticmethod
-    def _add_accordingly(add_now, first_node_bounding_rect, second_node_bounding_rect, first_node, second_node):
+    def _add_accordingly(add_now, first_node_bounding_rect, second_node_bounding_rect, first_node, second_node,
+                         cell: int = 1):
         first_node_new_rect = min_bounding_box(add_now.get_bounding_box(), first_node_bounding_rect)
         second_node_new_rect = min_bounding_box(add_now.get_bounding_box(), second_node_bounding_rect)
 
-        first_node_dif = bounding_box_area(first_node_new_rect) - bounding_box_area(first_node_bounding_rect)
-        second_node_dif = bounding_box_area(second_node_new_rect) - bounding_box_area(second_node_bounding_rect)
+        first_node_dif = bounding_box_area(first_node_new_rect, cell) - bounding_box_area(first_node_bounding_rect, cell)
+        second_node_dif = bounding_box_area(second_node_new_rect, cell) - \
+            bounding_box_area(second_node_bounding_rect, cell)
 
         if first_node_dif < second_node_dif:
             first_node.add_entry(add_now)
@@ -170,10 +505,10 @@ class RTree:
         elif second_node_dif < first_node_dif:
             second_node.add_entry(add_now)
             second_node_bounding_rect = second_node_new_rect
-        elif bounding_box_area(first_node_bounding_rect) < bounding_box_area(second_node_bounding_rect):
+        elif bounding_box_area(first_node_bounding_rect, cell) < bounding_box_area(second_node_bounding_rect, cell):
             first_node.add_entry(add_now)
             first_node_bounding_rect = first_node_new_rect
-        elif bounding_box_area(second_node_bounding_rect) < bounding_box_area(first_node_bounding_rect):
+        elif bounding_box_area(second_node_bounding_rect, cell) < bounding_box_area(first_node_bounding_rect, cell):
             second_node.add_entry(add_now)
             second_node_bounding_rect = second_node_new_rect
         elif len(first_node.entries) < len(second_node.entries):
@@ -185,11 +520,10 @@ class RTree:
         return first_node_bounding_rect, second_node_bounding_rect
 
     def _linear_split(self, split_this: Node):
-        root_node = self._storage.get_node(0)
         # bounding box of all entries in the tree
-        total_bounding_box = root_node.entries[0].get_bounding_box()
-        for x, _ in enumerate(root_node.entries):
-            total_bounding_box = min_bounding_box(total_bounding_box, root_node.entries[x].get_bounding_box())
+        total_bounding_box = group_bounding_box(split_this.entries)
+        if self._storage.get_root_box() is not None:
+            total_bounding_box = min_bounding_box(total_bounding_box, self._storage.get_root_box())
 
         max_normalized_separation = float("-inf")
         first_entry = split_this.entries[0]
@@ -230,7 +564,8 @@ class RTree:
                                                                                         first_node_bounding_rect,
                                                                                         second_node_bounding_rect,
                                                                                         first_node,
-                                                                                        second_node)
+                                                                                        second_node,
+                                                                                        self._cell)
         return first_node, second_node
 
     def _quadratic_split(self, split_this: Node) -> Tuple[Node, Node]:
@@ -238,7 +573,7 @@ class RTree:
         max_area_pair = tuple()
         for pair in combinations(split_this.entries, 2):
             bounding_box = min_bounding_box(pair[0].get_bounding_box(), pair[1].get_bounding_box())
-            box_area = bounding_box_area(bounding_box)
+            box_area = bounding_box_area(bounding_box, self._cell)
             if box_area > max_area:
                 max_area = box_area
                 max_area_pair = (pair[0], pair[1])
@@ -254,12 +589,13 @@ class RTree:
         second_node.add_entry(max_area_pair[1])
 
         while entries_left:
-            add_now = pick_next(entries_left, first_node_bounding_rect, second_node_bounding_rect)
+            add_now = pick_next(entries_left, first_node_bounding_rect, second_node_bounding_rect, self._cell)
             first_node_bounding_rect, second_node_bounding_rect = self._add_accordingly(add_now,
                                                                                         first_node_bounding_rect,
                                                                                         second_node_bounding_rect,
                                                                                         first_node,
-                                                                                        second_node)
+                                                                                        second_node,
+                                                                                        self._cell)
 
         return first_node, second_node
 
@@ -296,12 +632,12 @@ class RTree:
             first_bounding_box = first_entries[0].get_bounding_box()
             for entry in first_entries:
                 first_bounding_box = min_bounding_box(first_bounding_box, entry.get_bounding_box())
-            first_area = bounding_box_area(first_bounding_box)
+            first_area = bounding_box_area(first_bounding_box, self._cell)
 
             second_bounding_box = second_entries[0].get_bounding_box()
             for entry in second_entries:
                 second_bounding_box = min_bounding_box(second_bounding_box, entry.get_bounding_box())
-            second_area = bounding_box_area(second_bounding_box)
+            second_area = bounding_box_area(second_bounding_box, self._cell)
 
             total_area = first_area+second_area
             if total_area < min_area_combined:
@@ -328,106 +664,816 @@ class RTree:
             return self._quadratic_split(split_this)
         elif insert_node == RTreeSplitType.LINEAR:
             return self._linear_split(split_this)
+        elif insert_node == RTreeSplitType.RSTAR:
+            return self._rstar_split(split_this)
         pass
 
+    def _height(self) -> int:
+        return self._storage.get_height()
+
+    @staticmethod
+    def _rstar_choose_subtree(node: Node, new_entry, leaf_parent: bool, cell: int = 1) -> int:
+        new_box = new_entry.get_bounding_box()
+        candidates = list()
+        for idx, entry in enumerate(node.entries):
+            box = entry.get_bounding_box()
+            enlarged = min_bounding_box(box, new_box)
+            area = bounding_box_area(box, cell)
+            candidates.append((bounding_box_area(enlarged, cell) - area, area, idx, box, enlarged))
+        candidates.sort(key=lambda c: c[:3])
+        # without enlargement the overlap cannot grow either
+        if not leaf_parent or candidates[0][0] == 0:
+            return candidates[0][2]
+
+        # children are leaves, minimizes the overlap with the other children first,
+        # only the candidates with the smallest area enlargement are worth checking
+        min_key = None
+        min_entry_idx = -1
+        for area_diff, area, idx, box, enlarged in candidates[:RTree._RSTAR_OVERLAP_CANDIDATES]:
+            overlap_diff = 0
+            for other_idx, other in enumerate(node.entries):
+                if other_idx != idx:
+                    overlap_diff += intersection_area(enlarged, other.get_bounding_box(), cell) - \
+                        intersection_area(box, other.get_bounding_box(), cell)
+
+            key = (overlap_diff, area_diff, area)
+            if min_key is None or key < min_key:
+                min_key = key
+                min_entry_idx = idx
+        return min_entry_idx
+
+    def _rstar_split(self, split_this: Node) -> Tuple[Node, Node]:
+        n = len(split_this.entries)
+        min_fill = max(1, math.floor(0.4 * (n - 1)))
+
+        def distributions(sorted_entries: list):
+            # bounding boxes of all prefixes and suffixes, each distribution is then a pair of them
+            prefixes = [sorted_entries[0].get_bounding_box()]
+            for entry in sorted_entries[1:]:
+                prefixes.append(min_bounding_box(prefixes[-1], entry.get_bounding_box()))
+            suffixes = [sorted_entries[-1].get_bounding_box()]
+            for entry in reversed(sorted_entries[:-1]):
+                suffixes.append(min_bounding_box(suffixes[-1], entry.get_bounding_box()))
+            for k in range(min_fill, n - min_fill + 1):
+                yield k, prefixes[k - 1], suffixes[n - k - 1]
+
+        # chooses the axis with the smallest sum of margins over all distributions
+        best_axis_sorts = None
+        min_margin = float('inf')
+        for dim in range(self.get_dimensions()):
+            sorts = [sorted(split_this.entries, key=lambda e: (e.get_bounding_box()[0][dim], e.get_bounding_box()[1][dim])),
+                     sorted(split_this.entries, key=lambda e: (e.get_bounding_box()[1][dim], e.get_bounding_box()[0][dim]))]
+            margin = 0
+            for sorted_entries in sorts:
+                for _, first_box, second_box in distributions(sorted_entries):
+                    margin += box_margin(first_box, self._cell) + box_margin(second_box, self._cell)
+            if margin < min_margin:
+                min_margin = margin
+                best_axis_sorts = sorts
+
+        # on that axis, the distribution with the smallest overlap, then the smallest area
+        min_key = None
+        min_distribution = None
+        for sorted_entries in best_axis_sorts:
+            for k, first_box, second_box in distributions(sorted_entries):
+                key = (intersection_area(first_box, second_box, self._cell),
+                       bounding_box_area(first_box, self._cell) + bounding_box_area(second_box, self._cell))
+                if min_key is None or key < min_key:
+                    min_key = key
+                    min_distribution = (sorted_entries[:k], sorted_entries[k:])
+
+        first_node = Node(is_leaf=split_this.is_leaf(), max_size=split_this.get_max_size())
+        second_node = Node(is_leaf=split_this.is_leaf(), max_size=split_this.get_max_size())
+        first_node.entries = min_distribution[0]
+        second_node.entries = min_distribution[1]
+        return first_node, second_node
+
+    @staticmethod
+    def _rstar_pick_reinsert(node: Node) -> Tuple[Node, list]:
+        # removes the entries whose centers are the farthest from the center of the node
+        node_box = group_bounding_box(node.entries)
+        dims = range(len(node_box[0]))
+
+        def center_distance(entry) -> int:
+            box = entry.get_bounding_box()
+            return sum((box_center(box, x) - box_center(node_box, x)) ** 2 for x in dims)
+
+        entries = sorted(node.entries, key=center_distance)
+        reinsert_count = max(1, math.floor(0.3 * len(entries)))
+        kept = Node(node.is_leaf(), node.get_max_size())
+        kept.entries = entries[:-reinsert_count]
+        # close reinsert, the nearest of the removed entries go first
+        return kept, entries[-reinsert_count:]
+
+    def _rstar_insert(self, new_entry, level: int, overflowed: set):
+        # levels are counted from the leaves, so they stay valid when the root splits
+        path = list()
+        node_idx = 0
+        node = self._storage.get_node(0)
+        node_level = self._height()
+        while node_level > level:
+            entry_idx = self._rstar_choose_subtree(node, new_entry, node_level == 1, self._cell)
+            path.append((node_idx, node, entry_idx))
+            node_idx = node.entries[entry_idx].child_idx
+            node = self._storage.get_node(node_idx)
+            node_level -= 1
+
+        node.add_entry(new_entry)
+        reinsert = list()
+        reinsert_level = None
+
+        while True:
+            second = None
+            if len(node.entries) > node.get_max_size():
+                if node_idx != 0 and node_level not in overflowed:
+                    # forced reinsertion, only on the first overflow of each level
+                    overflowed.add(node_level)
+                    node, reinsert = self._rstar_pick_reinsert(node)
+                    reinsert_level = node_level
+                else:
+                    node, second = self._rstar_split(node)
+                    if node_idx == 0:
+                        first_idx = self._storage.add_node(node)
+                        second_idx = self._storage.add_node(second)
+                        new_root = Node(False, self._storage._max_entries(False))
+                        new_root.add_entry(self._parent_entry(node, first_idx))
+                        new_root.add_entry(self._parent_entry(second, second_idx))
+                        self._storage.set_node(0, new_root)
+                        self._storage.set_height(self._height() + 1)
+                        break
+            self._storage.set_node(node_idx, node)
+            if not path:
+                break
+
+            parent_idx, parent, entry_idx = path.pop()
+            parent.set_entry(self._parent_entry(node, node_idx), entry_idx)
+            if second is not None:
+                parent.add_entry(self._parent_entry(second, self._storage.add_node(second)))
+            node_idx, node = parent_idx, parent
+            node_level += 1
+
+        for entry in reinsert:
+            self._rstar_insert(entry, reinsert_level, overflowed)
+
     def insert(self, indices: List[int], data: int):
-        to_insert = LeafEntry(indices, data)
-        idx, ret = self._choose_leaf(0, to_insert)
+        entry = LeafEntry(self._coord_type.convert(indices), data)
+        self._invalidate(entry.coord)
+        self._insert_entry(entry, 0)
+        self._commit(1)
+
+    # Inserts the points as one operation, nearby points descend together along the Hilbert curve,
+    # every touched node is written and its parent box recomputed once per batch
+    def insert_many(self, points: Iterable[Tuple[List[int], int]]):
+        entries = [LeafEntry(self._coord_type.convert(coord), data) for coord, data in points]
+        if not entries:
+            return
+        for entry in entries:
+            self._invalidate(entry.coord)
+
+        if self._storage.get_split_type() in (RTreeSplitType.RSTAR, RTreeSplitType.HILBERT):
+            # forced reinsertion and the Hilbert order work entry by entry, the batch only shares the commit
+            for entry in entries:
+                self._insert_entry(entry, 0)
+        else:
+            # a coarse curve is enough to keep nearby points together
+            shift = self._coord_type.get_bits() - self._BATCH_ORDER_BITS
+            keys = [hilbert_key([x >> shift for x in self._coord_type.to_grid(entry.coord)], self._BATCH_ORDER_BITS)
+                    for entry in entries]
+            entries = [entries[i] for i in sorted(range(len(entries)), key=keys.__getitem__)]
+
+            nodes = self._insert_batch(self._storage.get_node(0), entries)
+            while len(nodes) > 1:
+                # the root split, its parts move to new slots under a new root
+                parent_entries = [self._parent_entry(node, self._storage.add_node(node)) for node in nodes]
+                nodes = self._distribute(Node(False, self._storage._max_entries(False)), parent_entries)
+                self._storage.set_height(self._height() + 1)
+            self._storage.set_node(0, nodes[0])
+        self._commit(len(entries))
+
+    # Adds the entries under the node, returns the node followed by the nodes split off it
+    def _insert_batch(self, node: Node, entries: list) -> List[Node]:
+        if node.is_leaf():
+            return self._distribute(node, entries)
+
+        # entries are routed as single inserts would route them, the chosen boxes grow meanwhile
+        boxes = [entry.get_bounding_box() for entry in node.entries]
+        groups = dict()
+        for entry in entries:
+            idx = self._least_enlargement(boxes, entry.get_bounding_box())
+            boxes[idx] = min_bounding_box(boxes[idx], entry.get_bounding_box())
+            groups.setdefault(idx, []).append(entry)
+
+        split_off = list()
+        for idx, group in groups.items():
+            child_idx = node.entries[idx].child_idx
+            children = self._insert_batch(self._storage.get_node(child_idx), group)
+            self._storage.set_node(child_idx, children[0])
+            node.set_entry(self._parent_entry(children[0], child_idx), idx)
+            split_off.extend(self._parent_entry(child, self._storage.add_node(child)) for child in children[1:])
+        return self._distribute(node, split_off)
+
+    # Adds the entries to the node, an overflowing node is split and the following entries go to
+    # the recently used part that grows least
+    def _distribute(self, node: Node, entries: list) -> List[Node]:
+        capacity = node.get_max_size()
+        if len(node.entries) + len(entries) > 2 * capacity:
+            # split many ways at once, as the bulk load packs its nodes
+            groups = str_pack(list(node.entries) + entries, max(2, math.floor(capacity * self._BATCH_FILL)),
+                              self.get_dimensions())
+            nodes = [Node(node.is_leaf(), capacity) for _ in groups]
+            for packed, group in zip(nodes, groups):
+                packed.entries = group
+            return nodes
+
+        if not node.entries:
+            node.add_entry(entries[0])
+            entries = entries[1:]
+        # least recently used first
+        nodes = [node]
+        boxes = [group_bounding_box(node.entries)]
+        for entry in entries:
+            box = entry.get_bounding_box()
+            start = max(0, len(nodes) - self._BATCH_CANDIDATES)
+            idx = start + self._least_enlargement(boxes[start:], box)
+            target = nodes.pop(idx)
+            target_box = boxes.pop(idx)
+            if target.add_entry(entry):
+                nodes.append(target)
+                boxes.append(min_bounding_box(target_box, box))
+            else:
+                for part in self._split_node(target):
+                    nodes.append(part)
+                    boxes.append(group_bounding_box(part.entries))
+        return nodes
+
+    def _least_enlargement(self, boxes: list, box: Tuple[list, list]) -> int:
+        min_idx = -1
+        min_diff = min_area = float('inf')
+        for idx, current in enumerate(boxes):
+            area = bounding_box_area(current, self._cell)
+            diff = bounding_box_area(min_bounding_box(current, box), self._cell) - area
+            if diff < min_diff or (diff == min_diff and area < min_area):
+                min_idx, min_diff, min_area = idx, diff, area
+        return min_idx
+
+    # level counted from the leaves, 0 inserts a data point, higher levels insert whole subtrees
+    def _insert_entry(self, to_insert, level: int):
+        if self._storage.get_split_type() == RTreeSplitType.RSTAR:
+            self._rstar_insert(to_insert, level, set())
+            return
+        if self._storage.get_split_type() == RTreeSplitType.HILBERT:
+            self._hilbert_insert(to_insert, level)
+            return
+
+        idx, ret = self._choose_leaf(0, to_insert, self._height() - level if level else None)
         if type(ret) is tuple:
             new_root = Node(False, 2)
             first_node_idx = self._storage.add_node(ret[0])
             second_node_idx = self._storage.add_node(ret[1])
-            new_first_node = new_parent_entry(ret[0], first_node_idx)
-            new_second_node = new_parent_entry(ret[1], second_node_idx)
+            new_first_node = self._parent_entry(ret[0], first_node_idx)
+            new_second_node = self._parent_entry(ret[1], second_node_idx)
             new_root.add_entry(new_first_node)
             new_root.add_entry(new_second_node)
             self._storage.set_node(0, new_root)
+            self._storage.set_height(self._height() + 1)
         pass
 
-    def _search_dist(self, point: List[int], dist: int, number_of_entries: int) -> List[LeafEntry]:
-        node_queue = deque()
-        node_queue.append(self._storage.get_node(0))
-        return_list = list()
+    def _hilbert_key(self, entry) -> int:
+        if isinstance(entry, NonLeafEntry):
+            return entry.lhv
+        if entry.hilbert_key is None:
+            entry.hilbert_key = hilbert_key(self._coord_type.to_grid(entry.coord), self._coord_type.get_bits())
+        return entry.hilbert_key
+
+    # Parent entries of Hilbert trees also carry the largest Hilbert key of the node,
+    # of aggregate trees the number of data points under it
+    def _parent_entry(self, node: Node, idx: int) -> NonLeafEntry:
+        entry = new_parent_entry(node, idx)
+        if self._storage.get_split_type() == RTreeSplitType.HILBERT:
+            # entries are kept in the Hilbert order
+            entry.lhv = self._hilbert_key(node.entries[-1])
+        if self._storage.is_aggregate():
+            entry.count = len(node.entries) if node.is_leaf() else sum(child.count for child in node.entries)
+        return entry
+
+    # Position of the first entry with a larger Hilbert key
+    def _hilbert_position(self, node: Node, key: int) -> int:
+        low, high = 0, len(node.entries)
+        while low < high:
+            middle = (low + high) // 2
+            if self._hilbert_key(node.entries[middle]) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _hilbert_insert(self, new_entry, level: int):
+        key = self._hilbert_key(new_entry)
+        path = list()
+        node_idx = 0
+        node = self._storage.get_node(0)
+        node_level = self._height()
+        while node_level > level:
+            # the first child whose keys reach the new one, the last child past the end of the curve
+            entry_idx = next((i for i, entry in enumerate(node.entries) if entry.lhv >= key), len(node.entries) - 1)
+            path.append((node_idx, node, entry_idx))
+            node_idx = node.entries[entry_idx].child_idx
+            node = self._storage.get_node(node_idx)
+            node_level -= 1
+
+        node.insert_entry(new_entry, self._hilbert_position(node, key))
+        while path:
+            parent_idx, parent, entry_idx = path.pop()
+            if len(node.entries) > node.get_max_size():
+                self._hilbert_overflow(parent, entry_idx, node_idx, node)
+            else:
+                self._storage.set_node(node_idx, node)
+                parent.set_entry(self._parent_entry(node, node_idx), entry_idx)
+            node_idx, node = parent_idx, parent
+
+        if len(node.entries) <= node.get_max_size():
+            self._storage.set_node(0, node)
+            return
+
+        # the root has no siblings, it is split in two
+        new_root = Node(False, self._storage._max_entries(False))
+        half = len(node.entries) // 2
+        for entries in (node.entries[:half], node.entries[half:]):
+            child = Node(node.is_leaf(), node.get_max_size())
+            child.entries = entries
+            new_root.add_entry(self._parent_entry(child, self._storage.add_node(child)))
+        self._storage.set_node(0, new_root)
+        self._storage.set_height(self._height() + 1)
+
+    # Deferred splitting, the entries of an overflowing node are shared with its sibling and only
+    # when both are full the two are split into three
+    def _hilbert_overflow(self, parent: Node, entry_idx: int, node_idx: int, node: Node):
+        group = [(entry_idx, node_idx, node)]
+        sibling_idx = entry_idx + 1 if entry_idx + 1 < len(parent.entries) else entry_idx - 1
+        if sibling_idx >= 0:
+            sibling_node_idx = parent.entries[sibling_idx].child_idx
+            group.append((sibling_idx, sibling_node_idx, self._storage.get_node(sibling_node_idx)))
+            group.sort(key=lambda member: member[0])
+
+        entries = [entry for _, _, member in group for entry in member.entries]
+        count = len(group) if len(entries) <= len(group) * node.get_max_size() else len(group) + 1
+        size, rest = divmod(len(entries), count)
+
+        start = 0
+        for i in range(count):
+            end = start + size + (1 if i < rest else 0)
+            member = Node(node.is_leaf(), node.get_max_size())
+            member.entries = entries[start:end]
+            start = end
+            if i < len(group):
+                position, member_idx, _ = group[i]
+                self._storage.set_node(member_idx, member)
+                parent.set_entry(self._parent_entry(member, member_idx), position)
+            else:
+                parent.insert_entry(self._parent_entry(member, self._storage.add_node(member)), group[-1][0] + 1)
 
-        while node_queue:
-            this_node = node_queue.popleft()
-            if not this_node.is_leaf():
-                for entry in this_node.entries:
-                    if overlaps_distance(point, dist, entry.get_bounding_box()):
-                        node_queue.append(self._storage.get_node(entry.child_idx))
+    def _min_entries(self, is_leaf: bool) -> int:
+        return max(1, math.floor(self._storage._max_entries(is_leaf) * self._MIN_FILL))
+
+    def _find_leaf(self, node_idx: int, entry: LeafEntry, path: list) -> Optional[list]:
+        node = self._storage.get_node(node_idx)
+        path = path + [(node_idx, node)]
+        if node.is_leaf():
+            return path if entry in node.entries else None
+
+        for child in node.entries:
+            if is_in(entry.coord, child.get_bounding_box()):
+                found = self._find_leaf(child.child_idx, entry, path)
+                if found is not None:
+                    return found
+        return None
+
+    def delete(self, indices: List[int], data: int) -> bool:
+        to_delete = LeafEntry(self._coord_type.convert(indices), data)
+        path = self._find_leaf(0, to_delete, [])
+        if path is None:
+            return False
+
+        self._invalidate(to_delete.coord)
+        self._delete_entry(to_delete, path)
+        self._commit(-1)
+        return True
+
+    def _delete_entry(self, to_delete: LeafEntry, path: list):
+        node_idx, node = path.pop()
+        node.remove_entry(node.entries.index(to_delete))
+
+        # condense tree, underfull nodes are removed and their entries reinserted at their level
+        orphans = list()
+        level = 0
+        while path:
+            parent_idx, parent = path.pop()
+            entry_idx = next(i for i, entry in enumerate(parent.entries) if entry.child_idx == node_idx)
+            if len(node.entries) < self._min_entries(node.is_leaf()):
+                parent.remove_entry(entry_idx)
+                self._storage.free_node(node_idx)
+                orphans.append((level, node.entries))
             else:
-                for entry in this_node.entries:
-                    if overlaps_distance(point, dist, entry.get_bounding_box()):
-                        return_list.append(entry)
-                        if len(return_list) > number_of_entries:
-                            return return_list
-        return return_list
+                self._storage.set_node(node_idx, node)
+                parent.set_entry(self._parent_entry(node, node_idx), entry_idx)
+            node_idx, node = parent_idx, parent
+            level += 1
+        self._condense_root(node, orphans)
+
+    # Stores the changed root, reinserts the entries of removed nodes at their level (orphans of
+    # (level, entries)) and shrinks the root while it has a single child
+    def _condense_root(self, node: Node, orphans: list):
+        if not node.is_leaf() and not node.entries:
+            node = Node(True, self._storage._max_entries(True))
+            self._storage.set_height(0)
+        self._storage.set_node(0, node)
+
+        for level, entries in sorted(orphans, key=lambda orphan: -orphan[0]):
+            height = self._height()
+            for entry in entries:
+                if level <= height:
+                    self._insert_entry(entry, level)
+                else:
+                    # the tree got too low for the subtree, its points are inserted one by one
+                    for leaf_entry in self._release_subtree(entry, level):
+                        self._insert_entry(leaf_entry, 0)
+
+        root = self._storage.get_node(0)
+        while not root.is_leaf() and len(root.entries) == 1:
+            child_idx = root.entries[0].child_idx
+            root = self._storage.get_node(child_idx)
+            self._storage.set_node(0, root)
+            self._storage.free_node(child_idx)
+            self._storage.set_height(self._height() - 1)
+
+    # Moves the point in its leaf if the new position lies within the leaf box grown by margin,
+    # otherwise deletes and reinserts it
+    def update(self, data: int, old_indices: List[int], new_indices: List[int], margin: int = 0) -> bool:
+        old_entry = LeafEntry(self._coord_type.convert(old_indices), data)
+        path = self._find_leaf(0, old_entry, [])
+        if path is None:
+            return False
+
+        new_entry = LeafEntry(self._coord_type.convert(new_indices), data)
+        self._invalidate(old_entry.coord)
+        self._invalidate(new_entry.coord)
+        if self._storage.get_split_type() == RTreeSplitType.HILBERT:
+            # a moved point has to take its new place in the Hilbert order
+            self._delete_entry(old_entry, path)
+            self._insert_entry(new_entry, 0)
+            self._commit()
+            return True
+
+        leaf_idx, leaf = path[-1]
+        if len(path) > 1:
+            leaf_box = next(entry for entry in path[-2][1].entries if entry.child_idx == leaf_idx).get_bounding_box()
+            grown_box = ([x - margin for x in leaf_box[0]], [x + margin for x in leaf_box[1]])
+            if not is_in(new_entry.coord, grown_box):
+                self._delete_entry(old_entry, path)
+                self._insert_entry(new_entry, 0)
+                self._commit()
+                return True
+
+        leaf.set_entry(new_entry, leaf.entries.index(old_entry))
+        self._storage.set_node(leaf_idx, leaf)
+
+        # parent boxes are adjusted only as long as they change
+        path.pop()
+        node_idx, node = leaf_idx, leaf
+        while path:
+            parent_idx, parent = path.pop()
+            entry_idx = next(i for i, entry in enumerate(parent.entries) if entry.child_idx == node_idx)
+            node_entry = self._parent_entry(node, node_idx)
+            if parent.entries[entry_idx] == node_entry:
+                break
+            parent.set_entry(node_entry, entry_idx)
+            self._storage.set_node(parent_idx, parent)
+            node_idx, node = parent_idx, parent
+        self._commit()
+        return True
+
+    # Removes the points inside the box in one traversal, the tree is condensed once at the end
+    def delete_range(self, search_box: Tuple[list, list]) -> int:
+        root = self._storage.get_node(0)
+        orphans = list()
+        deleted = self._delete_inside(0, root, search_box, self._height(), orphans)
+        if not deleted:
+            return 0
+
+        self._condense_root(root, orphans)
+        self._commit(-deleted)
+        return deleted
+
+    # Removes the points inside the box under a node at level and returns their number, the node itself
+    # is stored by the caller; underfull children are freed and their entries added to orphans
+    def _delete_inside(self, node_idx: int, node: Node, search_box: Tuple[list, list], level: int,
+                       orphans: list) -> int:
+        if node.is_leaf():
+            inside = self._overlapping(node_idx, node, search_box)
+            if inside:
+                for entry in inside:
+                    self._invalidate(entry.coord)
+                removed = set(map(id, inside))
+                node.entries = [entry for entry in node.entries if id(entry) not in removed]
+            return len(inside)
+
+        deleted = 0
+        for child in self._overlapping(node_idx, node, search_box):
+            child_node = self._storage.get_node(child.child_idx)
+            child_deleted = self._delete_inside(child.child_idx, child_node, search_box, level - 1, orphans)
+            if not child_deleted:
+                continue
+
+            deleted += child_deleted
+            entry_idx = next(i for i, entry in enumerate(node.entries) if entry.child_idx == child.child_idx)
+            if len(child_node.entries) < self._min_entries(child_node.is_leaf()):
+                node.remove_entry(entry_idx)
+                self._storage.free_node(child.child_idx)
+                orphans.append((level - 1, child_node.entries))
+            else:
+                self._storage.set_node(child.child_idx, child_node)
+                node.set_entry(self._parent_entry(child_node, child.child_idx), entry_idx)
+        return deleted
+
+    # Frees all nodes under a non leaf entry and returns its data points
+    def _release_subtree(self, entry: NonLeafEntry, level: int) -> List[LeafEntry]:
+        node = self._storage.get_node(entry.child_idx)
+        self._storage.free_node(entry.child_idx)
+        if level == 1:
+            return list(node.entries)
+
+        leaf_entries = list()
+        for child in node.entries:
+            leaf_entries.extend(self._release_subtree(child, level - 1))
+        return leaf_entries
+
+    def _overlapping(self, node_idx: int, node: Node, search_box: Tuple[list, list]) -> list:
+        columns = self._columns.get(node_idx, node) if self._columns is not None else None
+        if columns is None:
+            return [entry for entry in node.entries if overlaps(entry.get_bounding_box(), search_box)]
+        return [node.entries[i] for i in columns.overlapping(search_box)]
+
+    def _min_distances(self, node_idx: int, node: Node, point: List[int]) -> List[int]:
+        columns = self._columns.get(node_idx, node) if self._columns is not None else None
+        dists = columns.min_distances(point) if columns is not None else None
+        if dists is None:
+            return [min_distance(point, entry.get_bounding_box()) for entry in node.entries]
+        return dists
 
     def search_range(self, search_box: Tuple[list, list]) -> List[Tuple[List[int], int]]:
+        if self._query_cache is None:
+            return self._search_range(search_box)
+
+        key = QueryCache.range_key(search_box)
+        result = self._query_cache.get(key)
+        if result is None:
+            result = self._search_range(search_box)
+            box = (list(search_box[0]), list(search_box[1]))
+            self._query_cache.put(key, result, lambda coord: is_in(coord, box))
+        return result
+
+    def _search_range(self, search_box: Tuple[list, list]) -> List[Tuple[List[int], int]]:
         node_queue = deque()
-        node_queue.append(self._storage.get_node(0))
+        node_queue.append(0)
         return_list = set()
 
         # loads from queue until entry on our position is found or not
         while node_queue:
-            this_node = node_queue.popleft()
+            node_idx = node_queue.popleft()
+            this_node = self._storage.get_node(node_idx)
 
             # if the node is not leaf, adds all child nodes that overlap our position to the queue
             if not this_node.is_leaf():
-                for entry in this_node.entries:
-                    if overlaps(entry.get_bounding_box(), search_box):
-                        node_queue.append(self._storage.get_node(entry.child_idx))
+                for entry in self._overlapping(node_idx, this_node, search_box):
+                    node_queue.append(entry.child_idx)
             # if the node is leaf, iterates through the entries and if found, returns the data on our desired position
             else:
-                for entry in this_node.entries:
-                    if overlaps(entry.get_bounding_box(), search_box):
-                        return_list.add(entry)
+                for entry in self._overlapping(node_idx, this_node, search_box):
+                    return_list.add(entry)
         ret_list = list()
         for entry in return_list:
-            ret_list.append((entry.coord, entry.data_point))
+            ret_list.append((list(entry.coord), entry.data_point))
         return ret_list
 
+    def search_range_iter(self, search_box: Tuple[list, list],
+                          limit: Optional[int] = None) -> Iterator[Tuple[List[int], int]]:
+        if limit is not None and limit <= 0:
+            return
+
+        node_stack = [0]
+        found = 0
+
+        # depth-first, children are pushed in reverse so they are visited in node order
+        while node_stack:
+            node_idx = node_stack.pop()
+            this_node = self._storage.get_node(node_idx)
+
+            if not this_node.is_leaf():
+                for entry in reversed(self._overlapping(node_idx, this_node, search_box)):
+                    node_stack.append(entry.child_idx)
+            else:
+                for entry in self._overlapping(node_idx, this_node, search_box):
+                    yield list(entry.coord), entry.data_point
+                    found += 1
+                    if found == limit:
+                        return
+
+    def search_range_many(self, search_boxes: List[Tuple[list, list]]) -> List[List[Tuple[List[int], int]]]:
+        if not search_boxes:
+            return []
+
+        # every queued node carries the queries whose box overlaps it
+        node_queue = deque()
+        node_queue.append((0, list(range(len(search_boxes)))))
+        return_lists = [set() for _ in search_boxes]
+
+        while node_queue:
+            node_idx, queries = node_queue.popleft()
+            this_node = self._storage.get_node(node_idx)
+
+            if not this_node.is_leaf():
+                children = dict()
+                for query in queries:
+                    for entry in self._overlapping(node_idx, this_node, search_boxes[query]):
+                        children.setdefault(entry.child_idx, []).append(query)
+                node_queue.extend(children.items())
+            else:
+                for query in queries:
+                    return_lists[query].update(self._overlapping(node_idx, this_node, search_boxes[query]))
+        return [[(list(entry.coord), entry.data_point) for entry in return_list] for return_list in return_lists]
+
+    # Number of data points in the box, aggregate trees count subtrees lying inside it without visiting them
+    def count_range(self, search_box: Tuple[list, list]) -> int:
+        aggregate = self._storage.is_aggregate()
+        node_stack = [0]
+        count = 0
+
+        while node_stack:
+            node_idx = node_stack.pop()
+            this_node = self._storage.get_node(node_idx)
+            entries = self._overlapping(node_idx, this_node, search_box)
+            if this_node.is_leaf():
+                count += len(entries)
+                continue
+
+            for entry in entries:
+                if aggregate and is_in(entry.first_coord, search_box) and is_in(entry.second_coord, search_box):
+                    count += entry.count
+                else:
+                    node_stack.append(entry.child_idx)
+        return count
+
     def search_knn(self, search_around: List[int], number_of_entries: int) -> List[Tuple[List[int], int]]:
-        root_node = self._storage.get_node(0)
-        # bounding box of all entries in the tree
-        total_bounding_box = root_node.entries[0].get_bounding_box()
-        for x in range(1, len(root_node.entries)):
-            total_bounding_box = min_bounding_box(total_bounding_box, root_node.entries[x].get_bounding_box())
-        first_coord_distance = 0
-        second_coord_distance = 0
-        for x in range(len(total_bounding_box[0])):
-            first_coord_distance += abs(total_bounding_box[0][x] - search_around[x])
-            second_coord_distance += abs(total_bounding_box[1][x] - search_around[x])
-        # max distance from point that is worth trying to cover
-        max_distance = max(first_coord_distance, second_coord_distance)*2
-
-        output_list = self._search_dist(search_around, max_distance, number_of_entries)
-        if len(output_list) <= number_of_entries:
-            ret_list = list()
-            for entry in output_list:
-                ret_list.append((entry.coord, entry.data_point))
-            return ret_list
-
-        min_distance = 0
-        closest_list = list()
-        list_init = False
-        while True:
-            if math.isclose(max_distance, min_distance):
-                ret_list = list()
-                for entry in range(number_of_entries):
-                    ret_list.append((closest_list[entry].coord, closest_list[entry].data_point))
-                return ret_list
-            new_distance = (min_distance + max_distance) / 2
-            output_list = self._search_dist(search_around, new_distance, number_of_entries)
-            if len(output_list) == number_of_entries:
-                ret_list = list()
-                for entry in output_list:
-                    ret_list.append((entry.coord, entry.data_point))
-                return ret_list
-            if len(output_list) > number_of_entries:
-                if not list_init or len(output_list) < len(closest_list):
-                    list_init = True
-                    closest_list = output_list
-                max_distance = new_distance
-            if len(output_list) < number_of_entries:
-                min_distance = new_distance
+        if self._query_cache is None:
+            return self._search_knn_root(search_around, number_of_entries)
+
+        key = QueryCache.knn_key(search_around, number_of_entries)
+        result = self._query_cache.get(key)
+        if result is None:
+            result = self._search_knn_root(search_around, number_of_entries)
+            point = list(search_around)
+            if not result and number_of_entries <= 0:
+                # no point ever joins the result
+                self._query_cache.put(key, result, lambda coord: False)
+            elif len(result) < number_of_entries:
+                # any new point joins the result
+                self._query_cache.put(key, result, lambda coord: True)
+            else:
+                # only points not farther than the last neighbour change the result
+                radius = min_distance(point, (result[-1][0], result[-1][0]))
+                self._query_cache.put(key, result, lambda coord: min_distance(point, (coord, coord)) <= radius)
+        return result
+
+    def _search_knn_root(self, search_around: List[int], number_of_entries: int) -> List[Tuple[List[int], int]]:
+        if self._storage.get_root_box() is None:
+            return []
+        return self._search_knn(search_around, number_of_entries, self._storage.get_node)
+
+    # The best-first searches of all points advance together over a common frontier, in every round
+    # each search takes its points until a node comes next and every such node is read once for all
+    # the searches waiting on it; entries farther than the k-th closest point queued are left out
+    def search_knn_many(self, points: List[List[int]], number_of_entries: int) -> List[List[Tuple[List[int], int]]]:
+        results = [[] for _ in points]
+        if number_of_entries <= 0 or self._storage.get_root_box() is None:
+            return results
+
+        # heaps as in _search_knn, with the negated distances of the closest points queued so far
+        heaps = [[(0, False, 0, 0, 0)] for _ in points]
+        closest = [[] for _ in points]
+        counter = 1
+        active = range(len(points))
+
+        while active:
+            waiting = dict()
+            for query in active:
+                heap, ret_list = heaps[query], results[query]
+                while heap and heap[0][1] and len(ret_list) < number_of_entries:
+                    item = heapq.heappop(heap)[4]
+                    ret_list.append((list(item.coord), item.data_point))
+                if heap and len(ret_list) < number_of_entries:
+                    waiting.setdefault(heap[0][4], []).append(query)
+
+            for node_idx, queries in waiting.items():
+                node = self._storage.get_node(node_idx)
+                columns = self._columns.get(node_idx, node, len(queries)) if self._columns is not None else None
+                is_leaf = node.is_leaf()
+                # distances of all the waiting searches at once, already cut by their bounds
+                candidates = columns.within([points[query] for query in queries],
+                                            [-closest[query][0] if len(closest[query]) == number_of_entries
+                                             else None for query in queries],
+                                            number_of_entries if is_leaf else None) if columns is not None else None
+                if candidates is None:
+                    candidates = [(range(len(node.entries)), self._min_distances(node_idx, node, points[query]))
+                                  for query in queries]
+
+                for query, (indices, dists) in zip(queries, candidates):
+                    heap, bound = heaps[query], closest[query]
+                    heapq.heappop(heap)
+                    for i, dist in zip(indices, dists):
+                        if len(bound) == number_of_entries and dist > -bound[0]:
+                            continue
+                        entry = node.entries[i]
+                        if is_leaf:
+                            heapq.heappush(heap, (dist, True, entry.data_point, counter, entry))
+                            if len(bound) < number_of_entries:
+                                heapq.heappush(bound, -dist)
+                            else:
+                                heapq.heapreplace(bound, -dist)
+                        else:
+                            heapq.heappush(heap, (dist, False, entry.child_idx, counter, entry.child_idx))
+                        counter += 1
+            active = [query for queries in waiting.values() for query in queries]
+        return results
+
+    # Pairs of points, the first from this tree and the second from the other one, at most distance apart
+    def join(self, other: 'RTree', distance) -> Iterator[Tuple[Tuple[List[int], int], Tuple[List[int], int]]]:
+        if distance < 0:
+            raise ValueError
+        return self._join(other, distance)
+
+    # Pairs of points with overlapping boxes, for points the ones at the same position
+    def intersection_join(self, other: 'RTree') -> Iterator[Tuple[Tuple[List[int], int], Tuple[List[int], int]]]:
+        return self._join(other, 0)
+
+    def _join(self, other: 'RTree', distance) -> Iterator[Tuple[Tuple[List[int], int], Tuple[List[int], int]]]:
+        if self.get_dimensions() != other.get_dimensions():
+            raise ValueError
+
+        first_box = self._storage.get_root_box()
+        second_box = other._storage.get_root_box()
+        if first_box is None or second_box is None:
+            return
+        max_dist = distance * distance
+
+        # synchronized depth-first traversal of node pairs closer than distance, so only the
+        # pairs on the way down are kept in memory
+        pair_stack = [(0, first_box, 0, second_box)]
+        while pair_stack:
+            first_idx, first_box, second_idx, second_box = pair_stack.pop()
+            first_node = self._storage.get_node(first_idx)
+            second_node = other._storage.get_node(second_idx)
+
+            # only entries close to the other node can take part in a pair
+            first_entries = [entry for entry in first_node.entries
+                             if box_distance(entry.get_bounding_box(), second_box) <= max_dist]
+            second_entries = [entry for entry in second_node.entries
+                              if box_distance(first_box, entry.get_bounding_box()) <= max_dist]
+
+            if first_node.is_leaf() and second_node.is_leaf():
+                for first, second in plane_sweep(first_entries, second_entries, distance, max_dist):
+                    yield (list(first.coord), first.data_point), (list(second.coord), second.data_point)
+            elif first_node.is_leaf():
+                # the trees differ in height, only the deeper one descends
+                pair_stack.extend((first_idx, first_box, entry.child_idx, entry.get_bounding_box())
+                                  for entry in reversed(second_entries))
+            elif second_node.is_leaf():
+                pair_stack.extend((entry.child_idx, entry.get_bounding_box(), second_idx, second_box)
+                                  for entry in reversed(first_entries))
+            else:
+                pairs = list(plane_sweep(first_entries, second_entries, distance, max_dist))
+                pair_stack.extend((first.child_idx, first.get_bounding_box(), second.child_idx,
+                                   second.get_bounding_box()) for first, second in reversed(pairs))
+
+    def _search_knn(self, search_around: List[int], number_of_entries: int,
+                    get_node: Callable[[int], Node]) -> List[Tuple[List[int], int]]:
+        # best-first traversal, (distance, is point, tie break, counter, node index or entry)
+        # nodes go before points of the same distance, so ties are resolved by the data point
+        # and not by the shape of the tree
+        heap = [(0, False, 0, 0, 0)]
+        counter = 1
+        ret_list = list()
+
+        while heap and len(ret_list) < number_of_entries:
+            _, is_point, _, _, item = heapq.heappop(heap)
+            if is_point:
+                ret_list.append((list(item.coord), item.data_point))
+                continue
+
+            node = get_node(item)
+            for entry, dist in zip(node.entries, self._min_distances(item, node, search_around)):
+                if node.is_leaf():
+                    heapq.heappush(heap, (dist, True, entry.data_point, counter, entry))
+                else:
+                    heapq.heappush(heap, (dist, False, entry.child_idx, counter, entry.child_idx))
+                counter += 1
+        return ret_list
@@ -5,6 +5,8 @@ class RTreeSplitType(Enum):
     BRUTE_FORCE = 1
     QUADRATIC = 2
     LINEAR = 3
+    RSTAR = 4
+    HILBERT = 5
 
     @classmethod
     def from_str(cls, value: str):
@@ -17,6 +19,12 @@ class RTreeSplitType(Enum):
         if value == 'linear':
             return cls.LINEAR
 
+        if value == 'rstar':
+            return cls.RSTAR
+
+        if value == 'hilbert':
+            return cls.HILBERT
+
         return None
 
     def to_str(self):
@@ -1,13 +1,32 @@
 from abc import ABC, abstractmethod
-from typing import Tuple
-import copy
+from typing import Tuple, Optional, Dict, List
 import os
+import mmap
+import time
+import threading
 import math
+import struct
+import zlib
 from .split_type import RTreeSplitType
-from .node import Node, NonLeafEntry, LeafEntry
+from .coord_type import CoordType
+from .node import Node
+from .buffer_pool import BufferPool
+from .codec import NodeCodec
+from .wal import WriteAheadLog
+from .sync_policy import SyncPolicy
+
+
+def key_size(split_type: RTreeSplitType, coord_type: CoordType, dim: int) -> int:
+    return coord_type.get_size() * dim if split_type == RTreeSplitType.HILBERT else 0
 
 
 class Storage(ABC):
+    def __init__(self):
+        # statistics of the tree kept up to date by the tree, None while unknown
+        self._height = None
+        self._entry_count = None
+        self._root_box = None
+
     @abstractmethod
     def get_dim(self) -> int:
         pass
@@ -20,11 +39,21 @@ class Storage(ABC):
     def get_split_type(self) -> RTreeSplitType:
         pass
 
+    @abstractmethod
+    def get_coord_type(self) -> CoordType:
+        pass
+
+    # Non leaf entries keep the number of data points in their subtrees
+    @abstractmethod
+    def is_aggregate(self) -> bool:
+        pass
+
     # Number of nodes
     @abstractmethod
     def count(self) -> int:
         pass
 
+    # The node shares its entries with the storage, they must not be modified in place
     @abstractmethod
     def get_node(self, index: int) -> Node:
         pass
@@ -33,28 +62,92 @@ class Storage(ABC):
     def set_node(self, index: int, node: Node):
         pass
 
-    # Returns index
+    # Returns index, reuses freed slots first
     @abstractmethod
     def add_node(self, node: Node) -> int:
         pass
 
+    @abstractmethod
+    def free_node(self, index: int):
+        pass
+
+    # Codec of the pages add_pages takes
+    @abstractmethod
+    def get_codec(self) -> NodeCodec:
+        pass
+
+    # Appends encoded pages after the last node, returns the index of the first; free slots are not reused
+    @abstractmethod
+    def add_pages(self, pages: List[bytearray]) -> int:
+        pass
+
+    # Number of levels below the root
+    def get_height(self) -> Optional[int]:
+        return self._height
+
+    def set_height(self, height: int):
+        self._height = height
+
+    def get_entry_count(self) -> Optional[int]:
+        return self._entry_count
+
+    def set_entry_count(self, entry_count: int):
+        self._entry_count = entry_count
+
+    # Bounding box of the whole tree, None for an empty tree
+    def get_root_box(self) -> Optional[Tuple[list, list]]:
+        return self._root_box
+
+    def set_root_box(self, root_box: Optional[Tuple[list, list]]):
+        self._root_box = root_box
+
+    # Ends an operation of the tree, all its changes become durable together
+    def commit(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def _entry_size(self, is_leaf: bool) -> int:
-        return 8 * self.get_dim() * (1 if is_leaf else 2) + 8
+        size = self.get_coord_type().get_size() * self.get_dim() * (1 if is_leaf else 2) + 8
+        return size if is_leaf else size + self._key_size() + (8 if self.is_aggregate() else 0)
+
+    # bytes of the Hilbert key kept by non leaf entries of Hilbert trees
+    def _key_size(self) -> int:
+        return key_size(self.get_split_type(), self.get_coord_type(), self.get_dim())
 
     def _max_entries(self, is_leaf: bool) -> int:
         return math.floor((self.get_node_size() - 9) / self._entry_size(is_leaf))
 
 
 class MemoryStorage(Storage):
-    def __init__(self, dim: int, node_size: int, split_type: RTreeSplitType):
+    def __init__(self, dim: int, node_size: int, split_type: RTreeSplitType,
+                 coord_type: CoordType = CoordType.INT64, aggregate: bool = False):
+        super().__init__()
         self._dim = dim
         self._node_size = node_size
         self._split_type = split_type
+        self._coord_type = coord_type
+        self._aggregate = aggregate
 
         if self._max_entries(False) < 2:
             raise ValueError
 
-        self._data = [(True, [])]
+        self._data = [(True, ())]
+        self._free = list()
+        self._height = 0
+        self._entry_count = 0
+        # layout of the pages the nodes are kept decoded from
+        self._codec = NodeCodec(dim, node_size, coord_type=coord_type, key_size=self._key_size(), aggregate=aggregate)
 
     def get_dim(self) -> int:
         return self._dim
@@ -65,53 +158,258 @@ class MemoryStorage(Storage):
     def get_split_type(self) -> RTreeSplitType:
         return self._split_type
 
+    def get_coord_type(self) -> CoordType:
+        return self._coord_type
+
+    def is_aggregate(self) -> bool:
+        return self._aggregate
+
     def count(self) -> int:
         return len(self._data)
 
     def get_node(self, index: int) -> Node:
         is_leaf = self._data[index][0]
         node = Node(is_leaf, self._max_entries(is_leaf))
-        node.entries = copy.deepcopy(self._data[index][1])
+        node.entries = self._data[index][1]
         return node
 
     def set_node(self, index: int, node: Node):
-        self._data[index] = (node.is_leaf(), copy.deepcopy(node.entries))
+        self._data[index] = (node.is_leaf(), tuple(node.entries))
 
     def add_node(self, node: Node) -> int:
-        self._data.append((node.is_leaf(), copy.deepcopy(node.entries)))
+        if self._free:
+            index = self._free.pop()
+            self._data[index] = (node.is_leaf(), tuple(node.entries))
+            return index
+
+        self._data.append((node.is_leaf(), tuple(node.entries)))
         return len(self._data) - 1
 
+    def free_node(self, index: int):
+        self._data[index] = (True, ())
+        self._free.append(index)
 
-class DiskStorage(Storage):
-    _HEADER_SIZE = 13
-    _CACHE_SIZE = 1024
+    def get_codec(self) -> NodeCodec:
+        return self._codec
 
-    def __init__(self, filename: str):
-        self._file = open(filename, 'r+b')
-        data = self._file.read(self._HEADER_SIZE)
-        self._dim = int.from_bytes(data[:4], byteorder='little', signed=False)
-        self._node_size = int.from_bytes(data[4:12], byteorder='little', signed=False)
-        self._split_type = RTreeSplitType(int.from_bytes(data[12:], byteorder='little', signed=False))
+    def add_pages(self, pages: List[bytearray]) -> int:
+        index = len(self._data)
+        self._data.extend(self._codec.decode(page) for page in pages)
+        return index
 
-        self._cache = []
 
-        for i in range(self._CACHE_SIZE):
-            # index, changed(bool), is_leaf, entries
-            self._cache.append((None, None, None, None))
+class DiskStorage(Storage):
+    # v1: dimensions(4B), node size(8B), split type(1B), nodes follow right after
+    _V1_HEADER_SIZE = 13
+    # v2: superblock padded to whole pages, so nodes of page size do not straddle pages
+    # magic, version(2B), dimensions(4B), node size(8B), split type(1B), coordinate type(1B), flags(1B),
+    # height(4B), entry count(8B), node count(8B), first free slot(8B), followed by the root box(8B per coord)
+    # and crc32
+    _MAGIC = b'\x89RTREE\r\n'
+    _SUPERBLOCK = struct.Struct('<8sHIQBBBIQQq')
+    _CRC = struct.Struct('<I')
+    _PAGE_SIZE = 4096
+    # superblock written by flush, stats below are valid only then
+    _CLEAN = 1
+    _HAS_HEIGHT = 2
+    _HAS_ENTRY_COUNT = 4
+    _HAS_ROOT_BOX = 8
+    # format options, non leaf nodes use the compact encoding, non leaf entries keep subtree counts
+    _COMPACT = 16
+    _AGGREGATE = 32
+    FORMAT_VERSION = 2
+
+    CACHE_PAGES = 1024
+
+    CHECKPOINT_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, filename: str, cache_pages: int = CACHE_PAGES, cache_bytes: Optional[int] = None,
+                 wal: bool = False, group_commit: int = 1, checkpoint_bytes: int = CHECKPOINT_BYTES,
+                 sync_policy: Optional[SyncPolicy] = None, pinned_levels: Optional[int] = None,
+                 pinned_bytes: Optional[int] = None):
+        super().__init__()
+        # closed until fully opened, a failed open leaves nothing for close
+        self._closed = True
+        self._file = open(filename, 'r+b')
+        try:
+            node_count, self._free_head = self._read_header()
+
+            if cache_bytes is not None:
+                cache_pages = max(1, cache_bytes // self._node_size)
+            self._cache = BufferPool(cache_pages)
+            self._codec = NodeCodec(self._dim, self._node_size, checksum=self._version >= 2, compact=self._compact,
+                                    coord_type=self._coord_type, key_size=self._key_size(), aggregate=self._aggregate)
+            self._positional_io = hasattr(os, 'pread')
+            self._io_lock = threading.Lock()
+
+            # redo log of committed operations, replayed if the tree was not closed properly
+            self._wal_filename = filename + '.wal'
+            if os.path.exists(self._wal_filename):
+                self._recover()
+                if not wal:
+                    os.remove(self._wal_filename)
+
+            if not self._clean:
+                # the superblock is stale, the tree recomputes its statistics
+                self._height = self._entry_count = self._root_box = None
+                self._free_head = None
+                self._file.seek(0, 2)
+                node_count = round((self._file.tell() - self._header_size) / self._node_size)
+                # a mapped file that was not closed still has the zero pages it grew by, no node is all zeros
+                zero = bytes(self._node_size)
+                while node_count > 1:
+                    self._file.seek(self._header_size + (node_count - 1) * self._node_size)
+                    if self._file.read(self._node_size) != zero:
+                        break
+                    node_count -= 1
+                self._file.truncate(self._header_size + node_count * self._node_size)
+            self._count = node_count
+            # indices of freed slots, the chain from the superblock or a scan of the file when first needed,
+            # a clean superblock without a chain has none
+            self._free = [] if self._clean and self._free_head is None else None
+
+            # pages changed by the running operation, kept out of the file until committed to the log
+            self._txn = dict()
+            self._checkpoint_bytes = checkpoint_bytes
+            self._wal = WriteAheadLog(self._wal_filename, self._count, group_commit) if wal else None
+
+            self._sync_policy = sync_policy if sync_policy is not None else SyncPolicy.on_flush()
+            self._operations = 0
+            self._last_flush = time.monotonic()
+
+            # top levels of the tree kept decoded outside the cache, never evicted,
+            # as many levels as asked for or as fit into the byte budget
+            self._pinned_levels = pinned_levels
+            self._pinned_bytes = pinned_bytes
+            # index -> (depth, is_leaf, entries)
+            self._pinned = dict()
+            self._pinned_changed = set()
+            self._pinned_depth = 0
+            # a change of the height moves nodes between levels, pins are rebuilt at the end of the operation
+            self._repin = False
+            self._open_io()
+            self._warm()
+        except Exception:
+            self._file.close()
+            raise
+        self._closed = False
 
     @classmethod
-    def write_header(cls, filename: str, dimensions: int, node_size: int, split_type: RTreeSplitType):
-        if math.floor((node_size - 9) / (16 * dimensions + 8)) < 2:
+    def write_header(cls, filename: str, dimensions: int, node_size: int, split_type: RTreeSplitType,
+                     version: int = FORMAT_VERSION, compact: bool = False, coord_type: CoordType = CoordType.INT64,
+                     aggregate: bool = False):
+        if version not in (1, 2) or (version < 2 and (compact or coord_type != CoordType.INT64 or
+                                                      split_type == RTreeSplitType.HILBERT or aggregate)):
+            raise ValueError
+        codec = NodeCodec(dimensions, node_size, checksum=version >= 2, compact=compact, coord_type=coord_type,
+                          key_size=key_size(split_type, coord_type, dimensions), aggregate=aggregate)
+        if codec.max_entries(False) < 2:
             raise ValueError
 
-        data = bytearray(cls._HEADER_SIZE + node_size)
-        data[:4] = dimensions.to_bytes(4, byteorder='little', signed=False)
-        data[4:12] = node_size.to_bytes(8, byteorder='little', signed=False)
-        data[12:13] = split_type.value.to_bytes(1, byteorder='little', signed=False)
-        data[13:14] = True.to_bytes(1, byteorder='little', signed=False)
+        if version == 1:
+            data = bytearray(cls._V1_HEADER_SIZE)
+            data[:4] = dimensions.to_bytes(4, byteorder='little', signed=False)
+            data[4:12] = node_size.to_bytes(8, byteorder='little', signed=False)
+            data[12:13] = split_type.value.to_bytes(1, byteorder='little', signed=False)
+        else:
+            flags = cls._CLEAN | cls._HAS_HEIGHT | cls._HAS_ENTRY_COUNT | (cls._COMPACT if compact else 0) | \
+                (cls._AGGREGATE if aggregate else 0)
+            data = cls._pack_superblock(dimensions, node_size, split_type, coord_type, flags, 0, 0, None, 1, None)
 
         with open(filename, 'wb') as file:
-            file.write(data)
+            file.write(data + codec.encode(True, ()))
+
+    @classmethod
+    def _superblock_size(cls, dimensions: int) -> int:
+        size = cls._SUPERBLOCK.size + 16 * dimensions + cls._CRC.size
+        return math.ceil(size / cls._PAGE_SIZE) * cls._PAGE_SIZE
+
+    @classmethod
+    def _pack_superblock(cls, dimensions: int, node_size: int, split_type: RTreeSplitType, coord_type: CoordType,
+                         flags: int, height: int, entry_count: int, root_box: Optional[Tuple[list, list]],
+                         node_count: int, free_head: Optional[int]) -> bytearray:
+        data = bytearray(cls._superblock_size(dimensions))
+        cls._SUPERBLOCK.pack_into(data, 0, cls._MAGIC, 2, dimensions, node_size, split_type.value, coord_type.value,
+                                  flags, height, entry_count, node_count, -1 if free_head is None else free_head)
+        if root_box is not None:
+            struct.pack_into('<{}{}'.format(2 * dimensions, coord_type.get_wide_format()), data, cls._SUPERBLOCK.size,
+                             *root_box[0], *root_box[1])
+        end = cls._SUPERBLOCK.size + 16 * dimensions
+        cls._CRC.pack_into(data, end, zlib.crc32(data[:end]))
+        return data
+
+    # Reads the dimensions, node size and split type, with v2 also the statistics,
+    # returns node count and the first free slot
+    def _read_header(self) -> Tuple[Optional[int], Optional[int]]:
+        data = self._file.read(self._SUPERBLOCK.size)
+        if data[:len(self._MAGIC)] != self._MAGIC:
+            self._version = 1
+            self._header_size = self._V1_HEADER_SIZE
+            self._dim = int.from_bytes(data[:4], byteorder='little', signed=False)
+            self._node_size = int.from_bytes(data[4:12], byteorder='little', signed=False)
+            self._split_type = RTreeSplitType(data[12])
+            self._coord_type = CoordType.INT64
+            self._clean = False
+            self._compact = False
+            self._aggregate = False
+            return None, None
+
+        (_, self._version, self._dim, self._node_size, split_type, coord_type, flags, height, entry_count, node_count,
+         free_head) = self._SUPERBLOCK.unpack(data)
+        if self._version != 2:
+            raise ValueError('unsupported format version')
+        self._split_type = RTreeSplitType(split_type)
+        self._coord_type = CoordType(coord_type)
+        self._header_size = self._superblock_size(self._dim)
+
+        end = self._SUPERBLOCK.size + 16 * self._dim
+        data += self._file.read(end + self._CRC.size - len(data))
+        if zlib.crc32(data[:end]) != self._CRC.unpack_from(data, end)[0]:
+            raise ValueError('corrupted superblock')
+
+        self._clean = bool(flags & self._CLEAN)
+        self._compact = bool(flags & self._COMPACT)
+        self._aggregate = bool(flags & self._AGGREGATE)
+        if flags & self._HAS_HEIGHT:
+            self._height = height
+        if flags & self._HAS_ENTRY_COUNT:
+            self._entry_count = entry_count
+        if flags & self._HAS_ROOT_BOX:
+            box = struct.unpack_from('<{}{}'.format(2 * self._dim, self._coord_type.get_wide_format()), data,
+                                     self._SUPERBLOCK.size)
+            self._root_box = (list(box[:self._dim]), list(box[self._dim:]))
+        return node_count, None if free_head < 0 else free_head
+
+    def _write_superblock(self):
+        flags = self._CLEAN if self._clean else 0
+        flags |= self._COMPACT if self._compact else 0
+        flags |= self._AGGREGATE if self._aggregate else 0
+        flags |= self._HAS_HEIGHT if self._height is not None else 0
+        flags |= self._HAS_ENTRY_COUNT if self._entry_count is not None else 0
+        flags |= self._HAS_ROOT_BOX if self._root_box is not None else 0
+        free = self._free_slots() if self._clean else None
+        self._write_bytes(0, self._pack_superblock(self._dim, self._node_size, self._split_type, self._coord_type,
+                                                   flags, self._height or 0, self._entry_count or 0, self._root_box,
+                                                   self._count, free[-1] if free else None))
+
+    # The first change after a flush marks the superblock stale
+    def _modified(self):
+        if self._clean:
+            self._clean = False
+            self._write_superblock()
+
+    def get_format_version(self) -> int:
+        return self._version
+
+    def is_compact(self) -> bool:
+        return self._compact
+
+    # capacities follow from the page encoding
+    def _entry_size(self, is_leaf: bool) -> int:
+        return self._codec.entry_size(is_leaf)
+
+    def _max_entries(self, is_leaf: bool) -> int:
+        return self._codec.max_entries(is_leaf)
 
     def get_dim(self) -> int:
         return self._dim
@@ -122,105 +420,327 @@ class DiskStorage(Storage):
     def get_split_type(self) -> RTreeSplitType:
         return self._split_type
 
+    def get_coord_type(self) -> CoordType:
+        return self._coord_type
+
+    def is_aggregate(self) -> bool:
+        return self._aggregate
+
     def count(self) -> int:
-        self._file.seek(0, 2)
-        return round((self._file.tell() - self._HEADER_SIZE) / self._node_size)
+        return self._count
 
     def get_node(self, index: int) -> Node:
-        i = self._get(index, True)
-        is_leaf = self._cache[i][2]
+        is_leaf, entries = self._fetch(index)
         node = Node(is_leaf, self._max_entries(is_leaf))
-        node.entries = copy.deepcopy(self._cache[i][3])
+        node.entries = entries
         return node
 
+    def _fetch(self, index: int) -> Tuple[bool, tuple]:
+        page = self._txn.get(index)
+        if page is None:
+            pinned = self._pinned.get(index)
+            if pinned is not None:
+                return pinned[1], pinned[2]
+            page = self._cache.get(index)
+        if page is None:
+            if index >= self.count():
+                raise IndexError
+            page = self._read(index)
+            self._write_back(self._cache.put(index, page[0], page[1], False))
+        if page[0] is None:
+            # free slot marker of the log, free slots read as empty leaves
+            return True, ()
+        return page
+
     def set_node(self, index: int, node: Node):
-        i = self._get(index, False)
+        if index >= self.count():
+            raise IndexError
 
-        self._cache[i] = (index, True, node.is_leaf(), copy.deepcopy(node.entries))
+        self._modified()
+        if self._wal is not None:
+            self._txn[index] = (node.is_leaf(), tuple(node.entries))
+        else:
+            self._put(index, node.is_leaf(), tuple(node.entries))
+        self._pin_children(index, node)
+
+    # changed pages go to their pin or to the cache
+    def _put(self, index: int, is_leaf: bool, entries: tuple):
+        pinned = self._pinned.get(index)
+        if pinned is not None:
+            self._pinned[index] = (pinned[0], is_leaf, entries)
+            self._pinned_changed.add(index)
+        else:
+            self._write_back(self._cache.put(index, is_leaf, entries, True))
+
+    # hits, misses, evictions, the number of cached and dirty pages and of pinned pages
+    def get_cache_stats(self) -> Dict[str, int]:
+        stats = self._cache.get_stats()
+        stats['pinned'] = len(self._pinned)
+        return stats
+
+    def set_height(self, height: int):
+        if self._height is not None and height != self._height:
+            self._repin = True
+        super().set_height(height)
+
+    # Pins whole levels from the root down while they fit the limits
+    def _warm(self):
+        self._unpin_all()
+        if self._pinned_levels is None and self._pinned_bytes is None:
+            return
+
+        level = [0]
+        depth = 0
+        while level and (self._pinned_levels is None or depth < self._pinned_levels):
+            if self._pinned_bytes is not None and \
+                    (len(self._pinned) + len(level)) * self._node_size > self._pinned_bytes:
+                break
+            next_level = list()
+            for index in level:
+                is_leaf, entries = self._pin(index, depth)
+                if not is_leaf:
+                    next_level.extend(entry.child_idx for entry in entries)
+            level = next_level
+            depth += 1
+        self._pinned_depth = depth
+
+    def _pin(self, index: int, depth: int) -> Tuple[bool, tuple]:
+        is_leaf, entries = self._fetch(index)
+        page = self._cache.take(index)
+        if page is not None and page[0]:
+            self._pinned_changed.add(index)
+        self._pinned[index] = (depth, is_leaf, entries)
+        return is_leaf, entries
+
+    # new children of a pinned node are pinned too, as long as their level is
+    def _pin_children(self, index: int, node: Node):
+        pinned = self._pinned.get(index)
+        if pinned is None or node.is_leaf() or pinned[0] + 1 >= self._pinned_depth:
+            return
+        for entry in node.entries:
+            if entry.child_idx not in self._pinned and \
+                    (self._pinned_bytes is None or (len(self._pinned) + 1) * self._node_size <= self._pinned_bytes):
+                self._pin(entry.child_idx, pinned[0] + 1)
+
+    # pinned pages go back to the cache, changed ones stay marked as changed
+    def _unpin_all(self):
+        for index, (_, is_leaf, entries) in sorted(self._pinned.items()):
+            self._write_back(self._cache.put(index, is_leaf, entries, index in self._pinned_changed))
+        self._pinned.clear()
+        self._pinned_changed.clear()
+        self._repin = False
 
     def add_node(self, node: Node) -> int:
-        index = self.count()
-        self._write(index, node.is_leaf(), node.entries)
+        self._modified()
+        free = self._free_slots()
+        if free:
+            index = free.pop()
+        else:
+            index = self._count
+            self._count += 1
+
+        if self._wal is not None:
+            self._txn[index] = (node.is_leaf(), tuple(node.entries))
+        else:
+            self._write(index, node.is_leaf(), tuple(node.entries))
+        return index
 
+    def free_node(self, index: int):
+        self._modified()
+        free = self._free_slots()
+        self._cache.discard(index)
+        self._pinned.pop(index, None)
+        self._pinned_changed.discard(index)
+        # is_leaf None marks a free slot, with the next free slot in place of the entries
+        next_free = free[-1] if free else None
+        if self._wal is not None:
+            self._txn[index] = (None, next_free)
+        else:
+            self._write(index, None, next_free)
+        free.append(index)
+
+    def get_codec(self) -> NodeCodec:
+        return self._codec
+
+    # without the log the pages go to the file as they are, in a single write
+    def add_pages(self, pages: List[bytearray]) -> int:
+        self._modified()
+        index = self._count
+        self._count += len(pages)
+        if self._wal is not None:
+            for i, page in enumerate(pages):
+                self._txn[index + i] = self._codec.decode(page)
+        elif pages:
+            self._write_bytes(self._header_size + index * self._node_size, b''.join(pages))
         return index
 
-    def _get(self, index: int, read: bool):
-        if index >= self.count():
-            raise IndexError
+    def commit(self):
+        if self._wal is not None and self._txn:
+            for index, (is_leaf, entries) in sorted(self._txn.items()):
+                self._wal.append_page(index, self._encode(is_leaf, entries))
+            self._wal.commit(self._count)
+
+            txn, self._txn = self._txn, dict()
+            for index, (is_leaf, entries) in sorted(txn.items()):
+                self._put(index, is_leaf, entries)
+
+        if self._repin:
+            self._warm()
+
+        self._operations += 1
+        if self._wal is not None and self._wal.size() > self._checkpoint_bytes:
+            self.flush()
+        elif self._sync_policy.is_due(self._operations, self._last_flush):
+            self.flush()
+
+    # Writes all changed pages in file order, syncs the file unless the policy says never
+    # and with the log also empties it, which makes it a checkpoint
+    def flush(self):
+        pinned = [(index, self._pinned[index][1], self._pinned[index][2]) for index in self._pinned_changed]
+        self._pinned_changed.clear()
+        self._write_back(sorted(self._cache.flush() + pinned, key=lambda page: page[0]))
+        if self._version >= 2 and not self._clean:
+            self._clean = True
+            self._write_superblock()
+        if self._wal is not None or self._sync_policy.syncs():
+            self._sync_file()
+        if self._wal is not None:
+            self._wal.reset(self._count)
+        self._operations = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._close_file()
+        if self._wal is not None:
+            self._wal.close()
+            os.remove(self._wal_filename)
+        self._closed = True
+
+    def _recover(self):
+        node_count, pages = WriteAheadLog.read(self._wal_filename)
+        for index, data in pages:
+            self._file.seek(self._header_size + index * self._node_size)
+            self._file.write(data)
+        if node_count is not None:
+            self._file.truncate(self._header_size + node_count * self._node_size)
+        self._clean = False
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    # prepares the file for _read_bytes and _write_bytes, before the first page is read
+    def _open_io(self):
+        pass
 
-        i = index % self._CACHE_SIZE
-        if self._cache[i][0] is None or self._cache[i][0] != index:
-            if self._cache[i][1] is not None and self._cache[i][1]:
-                self._write(self._cache[i][0], self._cache[i][2], self._cache[i][3])
-
-            if read:
-                is_leaf, entries = self._read(index)
-                self._cache[i] = (index, False, is_leaf, entries)
-        return i
-
-    def _write(self, index: int, is_leaf: bool, entries: list):
-        data = bytearray(self._node_size)
-        data[:1] = is_leaf.to_bytes(1, byteorder='little', signed=False)
-        data[1:9] = len(entries).to_bytes(8, byteorder='little', signed=False)
-
-        i = 9
-
-        for entry in entries:
-            if is_leaf:
-                i = self._serialize_coord(data, i, entry.coord)
-                data[i:i+8] = entry.data_point.to_bytes(8, byteorder='little', signed=False)
-                i += 8
-            else:
-                i = self._serialize_coord(data, i, entry.first_coord)
-                i = self._serialize_coord(data, i, entry.second_coord)
-                data[i:i+8] = entry.child_idx.to_bytes(8, byteorder='little', signed=False)
-                i += 8
-
-        if len(data) > self.get_node_size():
-            raise ValueError
+    def _sync_file(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
 
-        self._file.seek(self._HEADER_SIZE + index * self._node_size)
-        self._file.write(data)
-
-    def _read(self, index: int) -> Tuple[bool, list]:
-        self._file.seek(self._HEADER_SIZE + index * self._node_size)
-        data = self._file.read(self._node_size)
-        is_leaf = bool.from_bytes(data[:1], byteorder='little', signed=False)
-        n = int.from_bytes(data[1:9], byteorder='little', signed=False)
-
-        i = 9
-        entries = []
-
-        for _ in range(n):
-            if is_leaf:
-                i, coord = self._deserialize_coord(data, i)
-                data_point = int.from_bytes(data[i:i+8], byteorder='little', signed=False)
-                i += 8
-                entries.append(LeafEntry(coord, data_point))
-            else:
-                i, first_coord = self._deserialize_coord(data, i)
-                i, second_coord = self._deserialize_coord(data, i)
-                child_idx = int.from_bytes(data[i:i+8], byteorder='little', signed=False)
-                i += 8
-                entries.append(NonLeafEntry(first_coord, second_coord, child_idx))
+    def _close_file(self):
+        self._file.close()
 
-        return is_leaf, entries
+    # the last free slot is reused first, each free slot points to the one freed before it
+    def _free_slots(self) -> List[int]:
+        if self._free is None and self._free_head is not None:
+            chain = list()
+            seen = set()
+            index = self._free_head
+            while index is not None:
+                data = self._read_page(index) if index not in seen and index < self._count else None
+                # a chain through a live page or back into itself is damaged, the file is scanned instead
+                if data is None or not self._codec.is_free(data):
+                    chain = None
+                    break
+                chain.append(index)
+                seen.add(index)
+                index = self._codec.next_free(data)
+            self._free = chain[::-1] if chain is not None else self._scan_free()
+        elif self._free is None:
+            self._free = self._scan_free()
+        return self._free
+
+    # Finds the free slots in the file and links them in index order, their old links follow
+    # the order they were freed in, which the list does not keep
+    def _scan_free(self) -> List[int]:
+        free = [i for i in range(self._count) if self._codec.is_free(self._read_page(i))]
+        for i, index in enumerate(free):
+            self._write_page(index, self._codec.encode_free(free[i - 1] if i else None))
+        return free
+
+    def _write_back(self, pages: List[Tuple[int, bool, tuple]]):
+        # a page may reach the file only after the log records of its changes
+        if pages and self._wal is not None:
+            self._wal.sync()
+        for index, is_leaf, entries in pages:
+            self._write(index, is_leaf, entries)
+
+    def _encode(self, is_leaf: Optional[bool], entries) -> bytearray:
+        return self._codec.encode_free(entries) if is_leaf is None else self._codec.encode(is_leaf, entries)
+
+    def _write(self, index: int, is_leaf: Optional[bool], entries):
+        self._write_page(index, self._encode(is_leaf, entries))
+
+    def _read(self, index: int) -> Tuple[bool, tuple]:
+        return self._codec.decode(self._read_page(index))
+
+    def _write_page(self, index: int, data: bytearray):
+        self._write_bytes(self._header_size + index * self._node_size, data)
+
+    def _read_page(self, index: int):
+        return self._read_bytes(self._header_size + index * self._node_size, self._node_size)
+
+    # positional reads and writes do not share the file position, so readers need no lock
+    def _write_bytes(self, offset: int, data: bytearray):
+        if self._positional_io:
+            os.pwrite(self._file.fileno(), data, offset)
+            return
+        with self._io_lock:
+            self._file.seek(offset)
+            self._file.write(data)
+            self._file.flush()
+
+    def _read_bytes(self, offset: int, size: int):
+        if self._positional_io:
+            return os.pread(self._file.fileno(), size, offset)
+        with self._io_lock:
+            self._file.seek(offset)
+            return self._file.read(size)
 
-    def _serialize_coord(self, data, i: int, coord: list) -> int:
-        for x in coord:
-            data[i:i+8] = x.to_bytes(8, byteorder='little', signed=True)
-            i += 8
-        return i
+    def __del__(self):
+        self.close()
 
-    def _deserialize_coord(self, data, i: int) -> Tuple[int, list]:
-        coord = []
-        for _ in range(self._dim):
-            coord.append(int.from_bytes(data[i:i+8], byteorder='little', signed=True))
-            i += 8
-        return i, coord
 
-    def __del__(self):
-        for index, changed, is_leaf, entries in self._cache:
-            if index is not None and changed:
-                self._write(index, is_leaf, entries)
+class MappedDiskStorage(DiskStorage):
+    # number of nodes the mapping grows by when it runs out of space
+    _GROW_NODES = 256
+
+    def _open_io(self):
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    # the lock keeps readers away from the mapping while _grow replaces it
+    def _write_bytes(self, offset: int, data: bytearray):
+        with self._io_lock:
+            if offset + len(data) > len(self._map):
+                self._grow(offset + len(data))
+            self._map[offset:offset + len(data)] = data
+
+    def _read_bytes(self, offset: int, size: int):
+        with self._io_lock:
+            return self._map[offset:offset + size]
+
+    def _grow(self, size: int):
+        size = max(size, len(self._map) + self._GROW_NODES * self._node_size)
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _sync_file(self):
+        self._map.flush()
+
+    def _close_file(self):
+        self._map.close()
+        # drops the pages preallocated by _grow
+        self._file.truncate(self._header_size + self._count * self._node_size)
         self._file.close()
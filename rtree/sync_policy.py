@@ -0,0 +1,53 @@
+import time
+from enum import Enum
+
+
+class SyncMode(Enum):
+    # changed pages are written on eviction and flush, the file is never synced
+    NEVER = 1
+    # changed pages are written and synced on flush and close
+    ON_FLUSH = 2
+    # flush after every N operations
+    EVERY_N = 3
+    # flush once the given number of seconds passed since the last one
+    INTERVAL = 4
+
+
+class SyncPolicy:
+    def __init__(self, mode: SyncMode, operations: int = 1, interval: float = 1.0):
+        if operations < 1 or interval <= 0:
+            raise ValueError
+
+        self._mode = mode
+        self._operations = operations
+        self._interval = interval
+
+    @classmethod
+    def never(cls):
+        return cls(SyncMode.NEVER)
+
+    @classmethod
+    def on_flush(cls):
+        return cls(SyncMode.ON_FLUSH)
+
+    @classmethod
+    def every(cls, operations: int):
+        return cls(SyncMode.EVERY_N, operations=operations)
+
+    @classmethod
+    def interval(cls, seconds: float):
+        return cls(SyncMode.INTERVAL, interval=seconds)
+
+    def get_mode(self) -> SyncMode:
+        return self._mode
+
+    def syncs(self) -> bool:
+        return self._mode != SyncMode.NEVER
+
+    # Whether an automatic flush is due after an operation
+    def is_due(self, operations: int, last_flush: float) -> bool:
+        if self._mode == SyncMode.EVERY_N:
+            return operations >= self._operations
+        if self._mode == SyncMode.INTERVAL:
+            return time.monotonic() - last_flush >= self._interval
+        return False
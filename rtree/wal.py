@@ -0,0 +1,87 @@
+import os
+import struct
+import zlib
+from typing import Optional, List, Tuple
+
+
+class WriteAheadLog:
+    # record type(1B), page index or node count(8B), payload length(4B), followed by the payload and crc32(4B)
+    _RECORD = struct.Struct('<BQI')
+    _CRC = struct.Struct('<I')
+    _PAGE = 1
+    _COMMIT = 2
+
+    def __init__(self, filename: str, node_count: int, group_commit: int = 1):
+        if group_commit < 1:
+            raise ValueError
+
+        self._filename = filename
+        self._group_commit = group_commit
+        self._file = open(filename, 'wb')
+        self._unsynced = 0
+        self.reset(node_count)
+
+    @classmethod
+    def read(cls, filename: str) -> Tuple[Optional[int], List[Tuple[int, bytes]]]:
+        # Returns node count and pages of committed transactions, a torn tail is ignored
+        node_count = None
+        committed = list()
+        pending = list()
+
+        with open(filename, 'rb') as file:
+            data = file.read()
+
+        i = 0
+        while i + cls._RECORD.size <= len(data):
+            record_type, value, length = cls._RECORD.unpack_from(data, i)
+            end = i + cls._RECORD.size + length
+            if end + cls._CRC.size > len(data):
+                break
+            if zlib.crc32(data[i:end]) != cls._CRC.unpack_from(data, end)[0]:
+                break
+
+            if record_type == cls._PAGE:
+                pending.append((value, data[i + cls._RECORD.size:end]))
+            elif record_type == cls._COMMIT:
+                committed.extend(pending)
+                pending = list()
+                node_count = value
+            else:
+                break
+            i = end + cls._CRC.size
+        return node_count, committed
+
+    def size(self) -> int:
+        return self._file.tell()
+
+    def append_page(self, index: int, data: bytes):
+        self._append(self._PAGE, index, data)
+
+    # Group commit, the log is synced once every group_commit commits
+    def commit(self, node_count: int):
+        self._append(self._COMMIT, node_count, b'')
+        self._unsynced += 1
+        if self._unsynced >= self._group_commit:
+            self.sync()
+
+    def sync(self):
+        if self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    # Empties the log after a checkpoint, keeping only the node count
+    def reset(self, node_count: int):
+        self._file.seek(0)
+        self._file.truncate()
+        self._append(self._COMMIT, node_count, b'')
+        self._unsynced = 1
+        self.sync()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def _append(self, record_type: int, value: int, payload: bytes):
+        record = self._RECORD.pack(record_type, value, len(payload)) + bytes(payload)
+        self._file.write(record + self._CRC.pack(zlib.crc32(record)))
@@ -1,10 +1,20 @@
 from typing import List, Tuple
+import gc
 import math
+import os
 import random
+import subprocess
+import sys
+import tempfile
 import unittest
 from collections import deque
-from rtree import RTree, RTreeSplitType
-from rtree.storage import Storage
+from rtree import RTree, RTreeSplitType, CoordType, SyncPolicy, QueryExecutor
+from rtree.storage import Storage, DiskStorage
+from rtree.codec import NodeCodec
+from rtree.hilbert import hilbert_key
+from rtree.columnar import ColumnCache
+from rtree.node import LeafEntry, NonLeafEntry
+from rtree.rtree import bounding_box_area, min_distance
 
 
 class TestRTree(RTree):
@@ -16,6 +26,27 @@ class TestRTree(RTree):
         super().insert(indices, data)
         self._seq_data.append((indices, data))
 
+    def insert_many(self, points: List[Tuple[List[int], int]]):
+        super().insert_many(points)
+        self._seq_data.extend(points)
+
+    def delete(self, indices: List[int], data: int) -> bool:
+        deleted = super().delete(indices, data)
+        if deleted:
+            self._seq_data.remove((indices, data))
+        return deleted
+
+    def delete_range(self, search_box: Tuple[list, list]) -> int:
+        deleted = super().delete_range(search_box)
+        self._seq_data = [x for x in self._seq_data if not self._is_inside(x[0], search_box)]
+        return deleted
+
+    def update(self, data: int, old_indices: List[int], new_indices: List[int], margin: int = 0) -> bool:
+        updated = super().update(data, old_indices, new_indices, margin)
+        if updated:
+            self._seq_data[self._seq_data.index((old_indices, data))] = (new_indices, data)
+        return updated
+
     def seq_search_range(self, search_box: Tuple[list, list]) -> List[Tuple[List[int], int]]:
         result = []
         for x in self._seq_data:
@@ -61,6 +92,7 @@ class TestCreateInsertSearch(unittest.TestCase):
         self._test_create(2, 512, RTreeSplitType.QUADRATIC)
         self._test_create(3, 1024, RTreeSplitType.LINEAR)
         self._test_create(4, 1024, RTreeSplitType.LINEAR)
+        self._test_create(2, 256, RTreeSplitType.RSTAR)
 
     def test_split(self):
         dim = random.randint(1, 5)
@@ -81,22 +113,23 @@ class TestCreateInsertSearch(unittest.TestCase):
         self.assertEqual(len(tree.search_range(box)), 2183)
 
     def test_leaks(self):
-        dim = random.randint(1, 5)
-        tree = self._create_rtree_and_insert(dim, 256, RTreeSplitType.LINEAR, 2000)
+        self._test_leaks(RTreeSplitType.LINEAR)
+        self._test_leaks(RTreeSplitType.RSTAR)
+        # non leaf entries of Hilbert trees also hold the key
+        self._test_leaks(RTreeSplitType.HILBERT, 512)
 
-        indexes = [0]
-        queue = deque()
-        queue.append(tree._storage.get_node(0))
+    def test_copy_on_write(self):
+        tree = self._create_rtree_and_insert(2, 128, RTreeSplitType.QUADRATIC, 20)
+        storage = tree._storage
+        self.assertIs(storage.get_node(0).entries, storage.get_node(0).entries)
 
-        while queue:
-            node = queue.popleft()
-            if not node.is_leaf():
-                for x in node.entries:
-                    indexes.append(x.child_idx)
-                    queue.append(tree._storage.get_node(x.child_idx))
+        node = storage.get_node(1)
+        size = len(node.entries)
+        node.add_entry(node.entries[0])
+        self.assertEqual(len(storage.get_node(1).entries), size)
 
-        for i in range(len(indexes)):
-            self.assertIn(i, indexes)
+        storage.set_node(1, node)
+        self.assertEqual(len(storage.get_node(1).entries), size + 1)
 
     def test_1d_128_brute_force_200_range(self):
         self._test_range(1, 128, RTreeSplitType.BRUTE_FORCE, 200)
@@ -146,6 +179,70 @@ class TestCreateInsertSearch(unittest.TestCase):
     def test_2d_128_linear_100_knn_greater(self):
         self._test_knn(2, 128, RTreeSplitType.LINEAR, 100, 120)
 
+    def test_2d_128_rstar_300_range(self):
+        self._test_range(2, 128, RTreeSplitType.RSTAR, 300)
+
+    def test_2d_128_rstar_300_knn(self):
+        self._test_knn(2, 128, RTreeSplitType.RSTAR, 300, 30)
+
+    def test_3d_512_rstar_1000_range(self):
+        self._test_range(3, 512, RTreeSplitType.RSTAR, 1000)
+
+    def test_3d_512_rstar_1000_knn(self):
+        self._test_knn(3, 512, RTreeSplitType.RSTAR, 1000, 50)
+
+    def test_2d_256_hilbert_1000_range(self):
+        self._test_range(2, 256, RTreeSplitType.HILBERT, 1000)
+
+    def test_3d_512_hilbert_1000_knn(self):
+        self._test_knn(3, 512, RTreeSplitType.HILBERT, 1000, 50)
+
+    def test_hilbert(self):
+        dim = random.randint(1, 3)
+        tree = self._create_rtree_and_insert(dim, 256, RTreeSplitType.HILBERT, 1500)
+        for coord, i in list(tree._seq_data[:300]):
+            self.assertTrue(tree.delete(coord, i))
+        for coord, i in list(tree._seq_data[:300]):
+            self.assertTrue(tree.update(i, coord, self._random_point(dim)))
+        self._assert_reachable(tree)
+
+        # entries of every node follow the Hilbert curve
+        nodes = [tree._storage.get_node(0)]
+        leaf_entries = 0
+        while nodes:
+            node = nodes.pop()
+            keys = [tree._hilbert_key(entry) for entry in node.entries]
+            self.assertEqual(keys, sorted(keys))
+            if node.is_leaf():
+                leaf_entries += len(node.entries)
+                # keys cached on the entries equal the computed ones
+                self.assertEqual(keys, [hilbert_key(tree._coord_type.to_grid(entry.coord), tree._coord_type.get_bits())
+                                        for entry in node.entries])
+            else:
+                nodes.extend(tree._storage.get_node(entry.child_idx) for entry in node.entries)
+        self.assertEqual(leaf_entries, 1200)
+        box = self._random_box(dim)
+        self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+
+        data = [(self._random_point(2), i) for i in range(3000)]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'hilbert.rtree')
+            with TestRTree.bulk_load_in_file(filename, data, 2, 512, RTreeSplitType.HILBERT) as tree:
+                tree._seq_data = list(data)
+                self._assert_reachable(tree)
+                # nodes of each level are stored one after another in the order of the curve
+                first_child = tree._storage.get_node(tree._storage.get_node(0).entries[0].child_idx)
+                children = [entry.child_idx for entry in first_child.entries]
+                self.assertEqual(children, list(range(children[0], children[0] + len(children))))
+                for coord, i in data[:100]:
+                    tree.insert([x + 1 for x in coord], 3000 + i)
+                self._assert_reachable(tree)
+            with TestRTree.from_file(filename) as tree:
+                tree._seq_data = data + [([x + 1 for x in coord], 3000 + i) for coord, i in data[:100]]
+                box = self._random_box(2)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                self._assert_reachable(tree)
+
     def test_2d_512_quadratic_1000_range(self):
         self._test_range(2, 512, RTreeSplitType.QUADRATIC, 1000)
 
@@ -164,6 +261,749 @@ class TestCreateInsertSearch(unittest.TestCase):
     def test_4d_512_linear_1000_knn(self):
         self._test_knn(4, 512, RTreeSplitType.LINEAR, 1000, 50)
 
+    def test_knn_ties(self):
+        tree = TestRTree.create_in_memory(2, 128, RTreeSplitType.QUADRATIC)
+        for i in reversed(range(100)):
+            tree.insert([i % 2, 0], i)
+
+        res = tree.search_knn([0, 0], 5)
+        self.assertEqual(res, [([0, 0], i) for i in range(0, 10, 2)])
+
+    def test_search_range_iter(self):
+        dim = random.randint(1, 4)
+        tree = self._create_rtree_and_insert(dim, 256, RTreeSplitType.LINEAR, 1000)
+        box = ([-1000 for _ in range(dim)], [1000 for _ in range(dim)])
+
+        res = list(tree.search_range_iter(box))
+        self._assert_range(tree.seq_search_range(box), res)
+        self.assertEqual(list(tree.search_range_iter(box, 10)), res[:10])
+        self.assertEqual(list(tree.search_range_iter(box, 0)), [])
+
+    def test_search_many(self):
+        dim = random.randint(1, 4)
+        tree = self._create_rtree_and_insert(dim, 256, RTreeSplitType.QUADRATIC, 1000)
+        boxes = [self._random_box(dim) for _ in range(20)]
+        points = [self._random_point(dim) for _ in range(20)]
+
+        for box, res in zip(boxes, tree.search_range_many(boxes)):
+            self._assert_range(tree.search_range(box), res)
+        for point, res in zip(points, tree.search_knn_many(points, 15)):
+            self.assertEqual(tree.search_knn(point, 15), res)
+        self.assertEqual(tree.search_range_many([]), [])
+        self.assertEqual(tree.search_knn_many([], 15), [])
+
+        self.assertEqual(tree.search_knn_many(points, 0), [[] for _ in points])
+
+        # searches of the same points take the same paths, ties of repeated points included
+        for coord_type in (CoordType.INT64, CoordType.FLOAT64):
+            dense = TestRTree.create_in_memory(dim, 256, RTreeSplitType.RSTAR, coord_type)
+            for i in range(300):
+                dense.insert([x + random.random() if coord_type == CoordType.FLOAT64 else x
+                              for x in self._random_point(dim)], i)
+            for coord, i in list(dense._seq_data[:100]):
+                dense.insert(coord, 1000 + i)
+            queries = [coord for coord, _ in dense._seq_data[:10]] + points
+            for k in (1, 30, 500):
+                self.assertEqual(dense.search_knn_many(queries, k), [dense.search_knn(point, k) for point in queries])
+        self.assertEqual(TestRTree.create_in_memory(dim, 256, RTreeSplitType.RSTAR).search_knn_many(points, 3),
+                         [[] for _ in points])
+
+    def test_delete(self):
+        for split_type in (RTreeSplitType.QUADRATIC, RTreeSplitType.RSTAR):
+            dim = random.randint(1, 3)
+            tree = self._create_rtree_and_insert(dim, 128, split_type, 600)
+            for coord, i in random.sample(tree._seq_data, 400):
+                self.assertTrue(tree.delete(coord, i))
+            self.assertFalse(tree.delete(self._random_point(dim), 600))
+
+            box = self._random_box(dim)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+            self._assert_range(tree._seq_data, tree.search_range(([-1000] * dim, [1000] * dim)))
+            self._assert_reachable(tree)
+
+    def test_delete_range(self):
+        dim = random.randint(1, 3)
+        tree = self._create_rtree_and_insert(dim, 128, RTreeSplitType.LINEAR, 600)
+        box = self._random_box(dim)
+        expected = len(tree.seq_search_range(box))
+        self.assertEqual(tree.delete_range(box), expected)
+        self.assertEqual(tree.search_range(box), [])
+
+        everything = ([-1000] * dim, [1000] * dim)
+        self.assertEqual(tree.delete_range(everything), 600 - expected)
+        self.assertEqual(tree.search_range(everything), [])
+        self.assertTrue(tree._storage.get_node(0).is_leaf())
+
+        # several boxes removed from trees kept in the Hilbert order and with subtree counts
+        for split_type in (RTreeSplitType.RSTAR, RTreeSplitType.HILBERT):
+            tree = TestRTree.create_in_memory(dim, 256, split_type, aggregate=True)
+            for i in range(1500):
+                tree.insert(self._random_point(dim), i)
+            for _ in range(4):
+                box = self._random_box(dim)
+                expected = len(tree.seq_search_range(box))
+                self.assertEqual(tree.delete_range(box), expected)
+                self.assertEqual(len(tree), len(tree._seq_data))
+                self._assert_range(tree._seq_data, tree.search_range(everything))
+                self.assertEqual(tree.count_range(everything), len(tree._seq_data))
+                self._assert_reachable(tree)
+
+    def test_delete_reuses_slots(self):
+        data = [(self._random_point(2), i) for i in range(500)]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'delete.rtree')
+            tree = TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.QUADRATIC)
+            for coord, i in data:
+                tree.insert(coord, i)
+            count = tree._storage.count()
+            for coord, i in data:
+                tree.delete(coord, i)
+            del tree
+
+            tree = TestRTree.from_file(filename)
+            for coord, i in data:
+                tree.insert(coord, i)
+            self.assertLessEqual(tree._storage.count(), count + 1)
+            self._assert_range(tree._seq_data, tree.search_range(([-1000, -1000], [1000, 1000])))
+
+    def test_update(self):
+        for margin in (0, 50):
+            dim = random.randint(1, 3)
+            tree = self._create_rtree_and_insert(dim, 128, RTreeSplitType.QUADRATIC, 500)
+            for _ in range(1000):
+                coord, i = random.choice(tree._seq_data)
+                new_coord = [x + random.randint(-30, 30) for x in coord]
+                self.assertTrue(tree.update(i, coord, new_coord, margin))
+            self.assertFalse(tree.update(500, self._random_point(dim), self._random_point(dim)))
+
+            box = self._random_box(dim)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+            self._assert_range(tree._seq_data, tree.search_range(([-2000] * dim, [2000] * dim)))
+            self._assert_reachable(tree)
+
+    def test_join(self):
+        dim = random.randint(1, 3)
+        first = self._create_rtree_and_insert(dim, 256, RTreeSplitType.QUADRATIC, 400)
+        data = [(self._random_point(dim), i) for i in range(1500)]
+        second = TestRTree.bulk_load(data, dim, 512, RTreeSplitType.LINEAR)
+        second._seq_data = data
+
+        for distance in (0, 25, 60.5):
+            expected = sorted((tuple(p), i, tuple(q), j) for p, i in first._seq_data for q, j in second._seq_data
+                              if math.dist(p, q) <= distance)
+            res = sorted((tuple(p), i, tuple(q), j) for (p, i), (q, j) in first.join(second, distance))
+            self.assertEqual(res, expected)
+        self.assertEqual(sorted((i, j) for (_, i), (_, j) in first.intersection_join(second)),
+                         sorted((i, j) for p, i in first._seq_data for q, j in second._seq_data if p == q))
+        self.assertEqual(list(first.join(TestRTree.create_in_memory(dim, 256, RTreeSplitType.LINEAR), 10)), [])
+
+    def test_aggregate(self):
+        def assert_counts(tree: RTree, node_idx: int = 0) -> int:
+            node = tree._storage.get_node(node_idx)
+            if node.is_leaf():
+                return len(node.entries)
+            total = 0
+            for entry in node.entries:
+                count = assert_counts(tree, entry.child_idx)
+                self.assertEqual(entry.count, count)
+                total += count
+            return total
+
+        dim = random.randint(1, 3)
+        for split_type in (RTreeSplitType.QUADRATIC, RTreeSplitType.RSTAR, RTreeSplitType.HILBERT):
+            tree = TestRTree.create_in_memory(dim, 256, split_type, aggregate=True)
+            for i in range(800):
+                tree.insert(self._random_point(dim), i)
+            for coord, i in random.sample(tree._seq_data, 300):
+                tree.delete(coord, i)
+            for coord, i in random.sample(tree._seq_data, 100):
+                tree.update(i, coord, [x + random.randint(-30, 30) for x in coord])
+            self.assertEqual(assert_counts(tree), 500)
+            for _ in range(10):
+                box = self._random_box(dim)
+                self.assertEqual(tree.count_range(box), len(tree.seq_search_range(box)))
+
+        data = [(self._random_point(dim), i) for i in range(3000)]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'aggregate.rtree')
+            TestRTree.bulk_load_in_file(filename, data, dim, 256, RTreeSplitType.LINEAR, workers=2, compact=True,
+                                        aggregate=True).close()
+            tree = TestRTree.from_file(filename)
+            tree._seq_data = list(data)
+            self.assertTrue(tree._storage.is_aggregate())
+            self.assertEqual(assert_counts(tree), 3000)
+            self.assertEqual(tree.count_range(([-2000] * dim, [2000] * dim)), 3000)
+            for _ in range(10):
+                box = self._random_box(dim)
+                self.assertEqual(tree.count_range(box), len(tree.seq_search_range(box)))
+            tree.close()
+
+        plain = self._create_rtree_and_insert(dim, 256, RTreeSplitType.LINEAR, 300)
+        box = self._random_box(dim)
+        self.assertEqual(plain.count_range(box), len(plain.seq_search_range(box)))
+
+    def test_insert_many(self):
+        for split_type in (RTreeSplitType.BRUTE_FORCE, RTreeSplitType.QUADRATIC, RTreeSplitType.LINEAR,
+                           RTreeSplitType.RSTAR, RTreeSplitType.HILBERT):
+            dim = random.randint(1, 3)
+            node_size = 160 if split_type == RTreeSplitType.BRUTE_FORCE else 512
+            tree = TestRTree.create_in_memory(dim, node_size, split_type, aggregate=True)
+            tree.insert_many([(self._random_point(dim), i) for i in range(1000)])
+            for i in range(1000, 1100):
+                tree.insert(self._random_point(dim), i)
+            tree.insert_many([(self._random_point(dim), i) for i in range(1100, 1600)])
+            tree.insert_many([])
+
+            self.assertEqual(len(tree), 1600)
+            self.assertEqual(tree.count_range(([-1000] * dim, [1000] * dim)), 1600)
+            for _ in range(5):
+                box = self._random_box(dim)
+                point = self._random_point(dim)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                self._assert_knn(tree.seq_search_knn(point, 10), tree.search_knn(point, 10), 10)
+            self._assert_reachable(tree)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'batch.rtree')
+            tree = TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.QUADRATIC, cache_pages=8)
+            for start in range(0, 3000, 1000):
+                tree.insert_many([(self._random_point(2), i) for i in range(start, start + 1000)])
+            tree.close()
+
+            tree = TestRTree.from_file(filename)
+            self.assertEqual(len(tree), 3000)
+            indexes = self._assert_reachable(tree)
+            self.assertEqual(sorted(indexes), list(range(tree._storage.count())))
+            self.assertEqual(len(tree.search_range(([-1000, -1000], [1000, 1000]))), 3000)
+            tree.close()
+
+    def test_bulk_load(self):
+        dim = random.randint(1, 4)
+        data = [(self._random_point(dim), i) for i in range(3000)]
+        tree = TestRTree.bulk_load(data, dim, 256, RTreeSplitType.LINEAR)
+        tree._seq_data = list(data)
+
+        box = self._random_box(dim)
+        self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+
+        point = self._random_point(dim)
+        self._assert_knn(tree.seq_search_knn(point, 30), tree.search_knn(point, 30), 30)
+
+    def test_bulk_load_fill_factor(self):
+        data = [(self._random_point(2), i) for i in range(1000)]
+        full = TestRTree.bulk_load(data, 2, 256, RTreeSplitType.QUADRATIC)
+        partial = TestRTree.bulk_load(data, 2, 256, RTreeSplitType.QUADRATIC, 0.7)
+        self.assertLess(full._storage.count(), partial._storage.count())
+
+        count = partial._storage.count()
+        partial.insert(self._random_point(2), 1000)
+        self.assertEqual(partial._storage.count(), count)
+
+    def test_parallel_bulk_load(self):
+        dim = random.randint(1, 3)
+        data = [(self._random_point(dim), i) for i in range(5000)]
+        box = self._random_box(dim)
+        point = self._random_point(dim)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'parallel.rtree')
+            with TestRTree.bulk_load_in_file(filename, data, dim, 256, RTreeSplitType.QUADRATIC, workers=3) as tree:
+                tree._seq_data = list(data)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                self._assert_knn(tree.seq_search_knn(point, 20), tree.search_knn(point, 20), 20)
+                indexes = self._assert_reachable(tree)
+                self.assertEqual(sorted(indexes), list(range(tree._storage.count())))
+
+            # workers encode the pages of compact files with checksums, the tree only moves them
+            filename = os.path.join(directory, 'compact.rtree')
+            with TestRTree.bulk_load_in_file(filename, data, dim, 256, RTreeSplitType.LINEAR, workers=2,
+                                             compact=True) as tree:
+                tree._seq_data = list(data)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+            with TestRTree.from_file(filename) as tree:
+                self.assertEqual(len(tree), 5000)
+
+        # memory trees decode the pages of the workers
+        floats = [([x + random.random() for x in coord], i) for coord, i in data]
+        tree = TestRTree.bulk_load(floats, dim, 256, RTreeSplitType.RSTAR, workers=2, coord_type=CoordType.FLOAT32)
+        tree._seq_data = [(CoordType.FLOAT32.convert(coord), i) for coord, i in floats]
+        self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+        self.assertEqual(len(tree), 5000)
+        indexes = self._assert_reachable(tree)
+        self.assertEqual(sorted(indexes), list(range(tree._storage.count())))
+        with self.assertRaises(ValueError):
+            TestRTree.bulk_load([([1] * (dim + 1), i) for i in range(1000)], dim, 256, RTreeSplitType.RSTAR, workers=2)
+
+    def test_bulk_load_in_file(self):
+        data = [(self._random_point(3), i) for i in range(2000)]
+        box = self._random_box(3)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'bulk.rtree')
+            tree = TestRTree.bulk_load_in_file(filename, data, 3, 512, RTreeSplitType.LINEAR)
+            tree._seq_data = list(data)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+
+    def test_disk_cache(self):
+        data = [(self._random_point(2), i) for i in range(1500)]
+        box = self._random_box(2)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'cache.rtree')
+            tree = TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.QUADRATIC, cache_pages=8)
+            for coord, i in data:
+                tree.insert(coord, i)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+
+            stats = tree._storage.get_cache_stats()
+            self.assertGreater(stats['hits'], 0)
+            self.assertGreater(stats['evictions'], 0)
+            self.assertLessEqual(stats['pages'], 8)
+            del tree
+
+            tree = TestRTree.from_file(filename, cache_bytes=256 * 4)
+            tree._seq_data = data
+            self.assertEqual(tree._storage._cache.get_capacity(), 4)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+
+    def test_pinned_levels(self):
+        data = [(self._random_point(2), i) for i in range(3000)]
+        box = self._random_box(2)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'pinned.rtree')
+            for wal, use_mmap in ((False, False), (True, False), (False, True)):
+                tree = TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.QUADRATIC, cache_pages=8, wal=wal,
+                                                use_mmap=use_mmap, pinned_levels=2)
+                for coord, i in data:
+                    tree.insert(coord, i)
+                for coord, i in data[:500]:
+                    tree.delete(coord, i)
+                tree._seq_data = data[500:]
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                root = tree._storage.get_node(0)
+                self.assertEqual(tree._storage.get_cache_stats()['pinned'], 1 + len(root.entries))
+                self.assertEqual(set(tree._storage._pinned), {0} | {entry.child_idx for entry in root.entries})
+                tree.close()
+
+            for use_mmap in (False, True):
+                tree = TestRTree.from_file(filename, cache_pages=8, use_mmap=use_mmap, pinned_bytes=256 * 100)
+                tree._seq_data = data[500:]
+                pinned = tree._storage.get_cache_stats()['pinned']
+                self.assertGreater(pinned, 1)
+                self.assertLessEqual(pinned, 100)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                self._assert_reachable(tree)
+                tree.close()
+
+    def test_split_type_in_header(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'rstar.rtree')
+            tree = TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.RSTAR)
+            del tree
+            self.assertEqual(TestRTree.from_file(filename)._storage.get_split_type(), RTreeSplitType.RSTAR)
+
+    def test_format_v2(self):
+        data = [(self._random_point(2), i) for i in range(1500)]
+        box = self._random_box(2)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'v2.rtree')
+            with TestRTree.create_in_file(filename, 2, 4096, RTreeSplitType.QUADRATIC) as tree:
+                for coord, i in data:
+                    tree.insert(coord, i)
+                for coord, i in data[:500]:
+                    tree.delete(coord, i)
+                height = tree._height()
+                root_box = tree._storage.get_root_box()
+                free = list(tree._storage._free_slots())
+                self.assertTrue(free)
+
+            # nodes start at page boundaries
+            self.assertEqual(os.path.getsize(filename) % 4096, 0)
+            with TestRTree.from_file(filename) as tree:
+                tree._seq_data = data[500:]
+                self.assertEqual(tree._storage.get_format_version(), 2)
+                self.assertEqual(tree._storage.get_height(), height)
+                self.assertEqual(tree._storage.get_root_box(), root_box)
+                self.assertEqual(tree._storage.get_entry_count(), 1000)
+                self.assertEqual(len(tree), 1000)
+                self.assertEqual(tree._storage._free_slots(), free)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                tree.insert(data[0][0], data[0][1])
+                left = tree._storage._free_slots()
+                self.assertEqual(left, free[:len(left)])
+
+            # a clean file without free slots is not scanned for them
+            full = os.path.join(directory, 'full.rtree')
+            with TestRTree.create_in_file(full, 2, 256, RTreeSplitType.QUADRATIC) as tree:
+                for coord, i in data:
+                    tree.insert(coord, i)
+            with TestRTree.from_file(full) as tree:
+                reads = list()
+                read_page = tree._storage._read_page
+                tree._storage._read_page = lambda index: reads.append(index) or read_page(index)
+                tree.insert(data[0][0], data[0][1])
+                tree.close()
+                self.assertLessEqual(len(reads), tree._height() + 1)
+
+            # a damaged page fails its checksum
+            with open(filename, 'r+b') as file:
+                file.seek(4096 + 20)
+                byte = file.read(1)[0]
+                file.seek(4096 + 20)
+                file.write(bytes([byte ^ 0xff]))
+            with self.assertRaises(ValueError):
+                tree = TestRTree.from_file(filename)
+                tree.search_range(([-10 ** 6] * 2, [10 ** 6] * 2))
+
+            # so does a damaged superblock, without leaving a half opened storage behind
+            with open(filename, 'r+b') as file:
+                file.seek(20)
+                byte = file.read(1)[0]
+                file.seek(20)
+                file.write(bytes([byte ^ 0xff]))
+            unraisable = list()
+            hook, sys.unraisablehook = sys.unraisablehook, unraisable.append
+            try:
+                with self.assertRaises(ValueError):
+                    TestRTree.from_file(filename)
+                gc.collect()
+            finally:
+                sys.unraisablehook = hook
+            self.assertEqual(unraisable, [])
+
+    def test_format_v1(self):
+        data = [(self._random_point(3), i) for i in range(600)]
+        box = self._random_box(3)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'v1.rtree')
+            DiskStorage.write_header(filename, 3, 256, RTreeSplitType.LINEAR, version=1)
+            with TestRTree.from_file(filename) as tree:
+                for coord, i in data:
+                    tree.insert(coord, i)
+                tree.delete(data[0][0], data[0][1])
+            self.assertEqual((os.path.getsize(filename) - 13) % 256, 0)
+
+            with TestRTree.from_file(filename) as tree:
+                tree._seq_data = data[1:]
+                self.assertEqual(tree._storage.get_format_version(), 1)
+                self.assertIsNone(tree._storage.get_entry_count())
+                self.assertEqual(len(tree), 599)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+
+    def test_compact(self):
+        dim = random.randint(2, 3)
+        data = [(self._random_point(dim), i) for i in range(3000)]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'compact.rtree')
+            tree = TestRTree.create_in_file(filename, dim, 512, RTreeSplitType.QUADRATIC, cache_pages=8, compact=True)
+            self.assertGreater(tree._storage._max_entries(False), 2 * TestRTree.create_in_memory(
+                dim, 512, RTreeSplitType.QUADRATIC)._storage._max_entries(False))
+            for coord, i in data:
+                tree.insert(coord, i)
+            tree.close()
+
+            tree = TestRTree.from_file(filename, cache_pages=8)
+            tree._seq_data = data
+            self.assertTrue(tree._storage.is_compact())
+            for _ in range(10):
+                box = self._random_box(dim)
+                point = self._random_point(dim)
+                self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                self._assert_knn(tree.seq_search_knn(point, 10), tree.search_knn(point, 10), 10)
+            for coord, i in data[:1000]:
+                self.assertTrue(tree.delete(coord, i))
+            box = self._random_box(dim)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+            tree.close()
+
+    def test_coord_types(self):
+        data = [(CoordType.FLOAT32.convert([random.uniform(-1000, 1000) for _ in range(2)]), i) for i in range(2000)]
+        with tempfile.TemporaryDirectory() as directory:
+            for split_type, compact in ((RTreeSplitType.RSTAR, False), (RTreeSplitType.QUADRATIC, True)):
+                filename = os.path.join(directory, 'float.rtree')
+                tree = TestRTree.create_in_file(filename, 2, 512, split_type, cache_pages=8, compact=compact,
+                                                coord_type=CoordType.FLOAT32)
+                self.assertEqual(tree._storage._max_entries(True), (512 - 13) // 16)
+                for coord, i in data:
+                    tree.insert(coord, i)
+                tree.close()
+
+                tree = TestRTree.from_file(filename, cache_pages=8)
+                tree._seq_data = list(data)
+                self.assertEqual(tree._storage.get_coord_type(), CoordType.FLOAT32)
+                for _ in range(10):
+                    box = ([random.uniform(-1000, 0) for _ in range(2)], [random.uniform(0, 1000) for _ in range(2)])
+                    point = [random.uniform(-1000, 1000) for _ in range(2)]
+                    self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+                    self._assert_knn(tree.seq_search_knn(point, 10), tree.search_knn(point, 10), 10)
+                self.assertTrue(tree.delete(data[0][0], data[0][1]))
+                tree.close()
+
+        self.assertEqual(bounding_box_area(([0.5, 1], [1.5, 3]), CoordType.FLOAT64.get_cell()), 2)
+        tree = TestRTree.create_in_memory(2, 256, RTreeSplitType.LINEAR, CoordType.INT32)
+        with self.assertRaises(ValueError):
+            tree.insert([2 ** 31, 0], 1)
+
+    def test_mmap(self):
+        data = [(self._random_point(3), i) for i in range(2000)]
+        box = self._random_box(3)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'mmap.rtree')
+            tree = TestRTree.create_in_file(filename, 3, 256, RTreeSplitType.LINEAR, cache_pages=16, use_mmap=True)
+            for coord, i in data:
+                tree.insert(coord, i)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+            count = tree._storage.count()
+            del tree
+
+            self.assertEqual(os.path.getsize(filename), 4096 + count * 256)
+            tree = TestRTree.from_file(filename)
+            tree._seq_data = data
+            self.assertEqual(tree._storage.count(), count)
+            self._assert_range(tree.seq_search_range(box), tree.search_range(box))
+            tree.close()
+
+            # a process killed after the mapping grew, the preallocated pages are not taken for nodes
+            script = '\n'.join([
+                'import os',
+                'from rtree import RTree',
+                'tree = RTree.from_file({!r}, use_mmap=True)'.format(filename),
+                'for coord, i in {!r}:'.format(data[:500]),
+                '    tree.insert(coord, i + 2000)',
+                'tree.flush()',
+                'tree._storage.set_node(0, tree._storage.get_node(0))',
+                'os._exit(0)'
+            ])
+            subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertGreater(os.path.getsize(filename), 4096 + count * 256)
+
+            tree = TestRTree.from_file(filename)
+            indexes = self._assert_reachable(tree)
+            self.assertEqual(sorted(indexes + tree._storage._free_slots()), list(range(tree._storage.count())))
+            self.assertEqual(len(tree), 2500)
+            tree.close()
+
+    @unittest.skipUnless(ColumnCache.available(), 'numpy is not installed')
+    def test_vectorized(self):
+        dim = random.randint(1, 4)
+        data = [(self._random_point(dim), i) for i in range(3000)]
+        tree = TestRTree.bulk_load(data, dim, 2048, RTreeSplitType.QUADRATIC)
+        box = self._random_box(dim)
+        point = self._random_point(dim)
+
+        range_res = tree.search_range(box)
+        knn_res = tree.search_knn(point, 40)
+        tree._columns = None
+        self._assert_range(tree.search_range(box), range_res)
+        self.assertEqual(tree.search_knn(point, 40), knn_res)
+
+        # small nodes are searched without numpy
+        small = TestRTree.bulk_load(data, dim, 256, RTreeSplitType.QUADRATIC)
+        self.assertIsNone(small._columns.get(0, small._storage.get_node(0)))
+
+        # float distances of the columns equal the ones computed without them, for single points and batches
+        floats = TestRTree.bulk_load([([x + random.random() for x in coord], i) for coord, i in data], dim, 2048,
+                                     RTreeSplitType.QUADRATIC, coord_type=CoordType.FLOAT64)
+        node_idx, node = 0, floats._storage.get_node(0)
+        while not node.is_leaf():
+            node_idx = node.entries[0].child_idx
+            node = floats._storage.get_node(node_idx)
+        points = [[x + random.random() for x in self._random_point(dim)] for _ in range(50)]
+        expected = [[min_distance(point, entry.get_bounding_box()) for entry in node.entries] for point in points]
+        columns = floats._columns.get(node_idx, node)
+        self.assertEqual([columns.min_distances(point) for point in points], expected)
+        self.assertEqual([dists for _, dists in columns.within(points, [None] * len(points))], expected)
+
+    def test_wal_recovery(self):
+        data = [(self._random_point(2), i) for i in range(800)]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'wal.rtree')
+            TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.QUADRATIC)
+            # the process is killed without closing the tree, only the log holds the last changes
+            script = '\n'.join([
+                'import os',
+                'from rtree import RTree',
+                'tree = RTree.from_file({!r}, cache_pages=4, wal=True, group_commit={})'.format(filename, 1),
+                'for coord, i in {!r}:'.format(data),
+                '    tree.insert(coord, i)',
+                'os._exit(0)'
+            ])
+            subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertTrue(os.path.exists(filename + '.wal'))
+
+            tree = TestRTree.from_file(filename)
+            tree._seq_data = data
+            self.assertFalse(os.path.exists(filename + '.wal'))
+            self._assert_range(data, tree.search_range(([-1000, -1000], [1000, 1000])))
+            self._assert_reachable(tree)
+            tree.close()
+
+            # slots freed under the log read back as empty leaves, as without it
+            tree = TestRTree.from_file(filename, wal=True)
+            tree._seq_data = list(data)
+            for coord, i in data[:500]:
+                tree.delete(coord, i)
+            for index in tree._storage._free_slots():
+                node = tree._storage.get_node(index)
+                self.assertTrue(node.is_leaf())
+                self.assertEqual(len(node.entries), 0)
+            self.assertEqual(sum(len(tree._storage.get_node(index).entries) for index in range(tree._storage.count())
+                                 if tree._storage.get_node(index).is_leaf()), 300)
+            tree.close()
+
+    def test_free_chain_after_recovery(self):
+        data = [(self._random_point(2), i) for i in range(2000)]
+
+        def scan(tree: RTree) -> List[int]:
+            storage = tree._storage
+            return [i for i in range(storage.count()) if storage._codec.is_free(storage._read_page(i))]
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'chain.rtree')
+            TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.QUADRATIC).close()
+            script = '\n'.join([
+                'import os',
+                'from rtree import RTree',
+                'tree = RTree.from_file({!r}, wal=True)'.format(filename),
+                'for coord, i in {!r}:'.format(data),
+                '    tree.insert(coord, i)',
+                'for coord, i in {!r}:'.format(data[:1500]),
+                '    tree.delete(coord, i)',
+                'os._exit(0)'
+            ])
+            subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+            tree = TestRTree.from_file(filename)
+            for i in range(60):
+                tree.insert(self._random_point(2), 2000 + i)
+            tree.close()
+
+            tree = TestRTree.from_file(filename)
+            self.assertEqual(sorted(tree._storage._free_slots()), scan(tree))
+            head = tree._storage._free_slots()[-1]
+            tree.close()
+
+            # a damaged chain is not followed
+            tree = TestRTree.from_file(filename)
+            tree._storage._write_page(head, tree._storage._codec.encode_free(head))
+            tree.close()
+            tree = TestRTree.from_file(filename)
+            self.assertEqual(sorted(tree._storage._free_slots()), scan(tree))
+            tree.insert(data[0][0], data[0][1])
+            self.assertEqual(len(tree), 501 + 60)
+            tree.close()
+
+    def test_flush_close(self):
+        data = [(self._random_point(2), i) for i in range(15)]
+        everything = ([-1000, -1000], [1000, 1000])
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'sync.rtree')
+            with TestRTree.create_in_file(filename, 2, 256, RTreeSplitType.LINEAR,
+                                          sync_policy=SyncPolicy.every(10)) as tree:
+                for coord, i in data[:10]:
+                    tree.insert(coord, i)
+                with TestRTree.from_file(filename) as reader:
+                    self.assertEqual(len(reader.search_range(everything)), 10)
+
+                for coord, i in data[10:]:
+                    tree.insert(coord, i)
+                with TestRTree.from_file(filename) as reader:
+                    self.assertEqual(len(reader.search_range(everything)), 10)
+
+                tree.flush()
+                with TestRTree.from_file(filename) as reader:
+                    self.assertEqual(len(reader.search_range(everything)), 15)
+            tree.close()
+
+            self.assertRaises(ValueError, SyncPolicy.every, 0)
+
+    def test_query_executor(self):
+        data = [(self._random_point(3), i) for i in range(2000)]
+        boxes = [self._random_box(3) for _ in range(40)]
+        points = [self._random_point(3) for _ in range(40)]
+        for use_mmap in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                filename = os.path.join(directory, 'threads.rtree')
+                TestRTree.bulk_load_in_file(filename, data, 3, 256, RTreeSplitType.LINEAR).close()
+
+                with TestRTree.from_file(filename, cache_pages=16, use_mmap=use_mmap) as tree:
+                    range_res = [tree.search_range(box) for box in boxes]
+                    knn_res = [tree.search_knn(point, 10) for point in points]
+                    with QueryExecutor(tree, 8) as executor:
+                        for expected, res in zip(range_res, executor.search_range(boxes)):
+                            self._assert_range(expected, res)
+                        self.assertEqual(executor.search_knn(points, 10), knn_res)
+                        self.assertEqual(executor.submit_knn(points[0], 10).result(), knn_res[0])
+
+    def test_query_cache(self):
+        dim = random.randint(1, 3)
+        tree = self._create_rtree_and_insert(dim, 256, RTreeSplitType.QUADRATIC, 500)
+        tree.enable_query_cache()
+        boxes = [self._random_box(dim) for _ in range(5)]
+        points = [self._random_point(dim) for _ in range(5)]
+        for i in range(500, 800):
+            for box in boxes:
+                self.assertEqual(sorted(tree.search_range(box)), sorted(tree._search_range(box)))
+            for point in points:
+                self.assertEqual(tree.search_knn(point, 5), tree._search_knn_root(point, 5))
+                self.assertEqual(tree.search_knn(point, 0), [])
+            if i % 3:
+                tree.insert(self._random_point(dim), i)
+            else:
+                coord, data = random.choice(tree._seq_data)
+                tree.update(data, coord, self._random_point(dim))
+            coord, data = random.choice(tree._seq_data)
+            tree.delete(coord, data)
+
+        stats = tree.get_query_cache_stats()
+        self.assertGreater(stats['hits'], 0)
+        self.assertGreater(stats['invalidations'], 0)
+        self.assertLessEqual(stats['invalidations'], stats['misses'])
+        self.assertLessEqual(stats['entries'], 15)
+
+        tree.enable_query_cache(4096)
+        for box in boxes:
+            tree.search_range(box)
+        stats = tree.get_query_cache_stats()
+        self.assertLessEqual(stats['bytes'], 4096)
+        tree.disable_query_cache()
+        self.assertIsNone(tree.get_query_cache_stats())
+
+    def test_codec(self):
+        codec = NodeCodec(3, 512)
+        leaves = tuple(LeafEntry(self._random_point(3), i) for i in range(10))
+        non_leaves = tuple(NonLeafEntry(*self._random_box(3), i) for i in range(8))
+
+        self.assertEqual(codec.decode(codec.encode(True, leaves)), (True, leaves))
+        self.assertEqual(codec.decode(codec.encode(False, non_leaves)), (False, non_leaves))
+        self.assertRaises(ValueError, codec.encode, True, leaves * 2)
+
+    def _test_leaks(self, split_type: RTreeSplitType, node_size: int = 256):
+        dim = random.randint(1, 5)
+        tree = self._create_rtree_and_insert(dim, node_size, split_type, 2000)
+
+        indexes = self._assert_reachable(tree)
+        for i in range(len(indexes)):
+            self.assertIn(i, indexes)
+
+    # Checks that all leaves are on the same level and the parent boxes are tight, returns node indices
+    def _assert_reachable(self, tree: TestRTree) -> List[int]:
+        indexes = [0]
+        leaf_levels = set()
+        queue = deque()
+        queue.append((tree._storage.get_node(0), 0))
+
+        while queue:
+            node, level = queue.popleft()
+            if not node.is_leaf():
+                for x in node.entries:
+                    child = tree._storage.get_node(x.child_idx)
+                    self.assertEqual(tree._parent_entry(child, x.child_idx), x)
+                    indexes.append(x.child_idx)
+                    queue.append((child, level + 1))
+            else:
+                leaf_levels.add(level)
+
+        self.assertEqual(len(leaf_levels), 1)
+        return indexes
+
     def _test_create(self, dim: int, node_size: int, split_type: RTreeSplitType):
         tree = TestRTree.create_in_memory(dim, node_size, split_type)
         self.assertEqual(tree.get_dimensions(), dim)